@@ -1,38 +1,23 @@
 import argparse
-import csv
 from datetime import date, timedelta
 import logging
 import subprocess
-import sys
-from tempfile import NamedTemporaryFile
+from typing import List
 
-from beancount.core.amount import Amount
+from beancount import loader
+from beancount.core import convert, prices
+from beancount.core.data import Transaction
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
 OUT_FILE = "out.png"
-QUERY = """
-select
-    date,
-    root(account, 2) as category,
-    account,
-    convert(position, 'USD') as spend
-where account ~ '^Expenses:'
-    {exclusions}
-    {inclusions}
-    and date > #"{start}";
-"""
-EXCLUSION = """
-and not account ~ '^{account}'
-"""
-INCLUSION = """
-and account ~ '^{account}'
-"""
+CURRENCY = "USD"
+EXPENSES = "Expenses:"
 
 args = None
-logger = None
+logger = logging.getLogger(__name__)
 
 
 def run():
@@ -63,56 +48,76 @@ def run():
         action="store_true",
         help="Use the full account name as group-by",
     )
-    global args, logger
+    global args
     args = parser.parse_args()
-    logger = logging.getLogger(__name__)
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.DEBUG if args.debug else logging.WARNING)
-    with NamedTemporaryFile(mode="w+") as outfile:
-        bean_query(outfile)
-        data = parse(outfile)
-    plot(data)
-
-
-def bean_query(outfile):
-    exclusions = [EXCLUSION.strip().format(account=ex) for ex in args.exclude]
-    inclusions = [INCLUSION.strip().format(account=inc) for inc in args.only]
-    query = QUERY.format(
-        start=get_start().isoformat(),
-        exclusions="\n".join(exclusions),
-        inclusions="\n".join(inclusions),
-    ).strip()
-    logger.debug(query)
-    _ret = subprocess.run(
-        [
-            "bean-query",
-            args.journal,
-            query,
-            "--format",
-            "csv",
-            "--output",
-            outfile.name,
-        ],
-        check=True,
-        text=True,
+    postings = load(args.journal)
+    data = select(postings, args.monthly, args.exclude, args.only)
+    plot(data, "account" if args.full_account else "category")
+
+
+def load(journal: str) -> pd.DataFrame:
+    """
+    Every expense posting in $journal, with its amount in CURRENCY.
+    The journal is parsed once, so any number of charts can select() from this.
+    Columns: date, account (categorical), spend
+    """
+    entries, errors, _ = loader.load_file(journal)
+    for error in errors:
+        logger.warning("%s", error.message)
+    price_map = prices.build_price_map(entries)
+    dates, accounts, spend = [], [], []
+    for entry in entries:
+        if not isinstance(entry, Transaction):
+            continue
+        for posting in entry.postings:
+            if not posting.account.startswith(EXPENSES):
+                continue
+            units = posting.units
+            if units.currency != CURRENCY:
+                # Same as convert(position, 'USD') in bean-query
+                units = convert.convert_position(posting, CURRENCY, price_map)
+            dates.append(entry.date)
+            accounts.append(posting.account)
+            spend.append(float(units.number))
+    postings = pd.DataFrame(
+        {
+            "date": pd.to_datetime(dates),
+            "account": pd.Categorical(accounts),
+            "spend": np.array(spend, dtype=float),
+        }
     )
-
-
-def parse(outfile):
-    data = pd.read_csv(
-        outfile,
-        parse_dates=[0],
-        converters={
-            "category": lambda x: x.split(":")[1].strip(),
-            "account": lambda x: ":".join(x.split(":")[1:]).strip(),
-            "spend": lambda x: pd.to_numeric(Amount.from_string(x).number),
-        },
-    )
-    start = get_start()
-    end = get_end()
+    logger.debug("%d expense postings in %s", len(postings), journal)
+    return postings
+
+
+def select(
+    postings: pd.DataFrame, monthly: bool, exclude: List[str], only: List[str]
+) -> pd.DataFrame:
+    """
+    The $postings in the period being looked at, without the $exclude accounts (and
+    only the $only ones, if any). Each is a prefix of the full account name.
+    Adds the "category" and (short) "account" to group by, and the date "bin".
+    """
+    start = get_start(monthly)
+    end = get_end(monthly)
+    accounts = postings["account"]
+    mask = postings["date"] > pd.Timestamp(start)
+    if exclude:
+        mask &= ~accounts.str.startswith(tuple(exclude))
+    if only:
+        mask &= accounts.str.startswith(tuple(only))
+    logger.debug("%d of %d postings selected", mask.sum(), len(postings))
+    data = postings[mask].copy()
+    # Expenses:Food:Groceries => category "Food", account "Food:Groceries"
+    # (map() on a categorical only calls these once per account)
+    names = data["account"].cat.remove_unused_categories()
+    data["category"] = names.map(lambda account: account.split(":")[1].strip())
+    data["account"] = names.map(lambda account: account[len(EXPENSES) :].strip())
     freq = (
         pd.offsets.MonthBegin()
-        if args.monthly
+        if monthly
         else pd.offsets.Week(weekday=end.weekday())
     )
     bins = pd.date_range(start=start, end=end, freq=freq)
@@ -120,13 +125,9 @@ def parse(outfile):
     return data
 
 
-def plot(data):
-    if args.full_account:
-        group_by = "account"
-    else:
-        group_by = "category"
-    daily_spend = data.groupby(["bin", group_by])
-    table = daily_spend.sum()["spend"].unstack()
+def plot(data: pd.DataFrame, group_by: str):
+    daily_spend = data.groupby(["bin", group_by], observed=False)
+    table = daily_spend["spend"].sum().unstack()
     sns.set()
     fig, ax = plt.subplots()
     fig.set_size_inches(12.8, 8.8)
@@ -139,16 +140,16 @@ def plot(data):
     subprocess.run(["open", OUT_FILE])
 
 
-def get_start():
-    if args.monthly:
+def get_start(monthly: bool) -> date:
+    if monthly:
         old = date.today() - timedelta(days=6 * 30)
         return old.replace(day=1)  # start from first of month
     else:
         return date.today() - timedelta(weeks=12)
 
 
-def get_end():
-    if args.monthly:
+def get_end(monthly: bool) -> date:
+    if monthly:
         new = date.today() + timedelta(days=30)
         return new.replace(day=1)  # end on first day of next month
     else:
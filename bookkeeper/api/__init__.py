@@ -1,20 +1,30 @@
 from flask import Flask
 from flask_cors import CORS
 
+from .compression import enable_gzip
 from .sort_app import create_sort_app
 from .collect_app import create_collect_app
 from .config_app import Config, create_config_app
+from .ledger_cache import LedgerCache
+from .ledger_writer import LedgerWriter
+from .serialise import DirectJSONProvider
 
 
 def create_app():
     app = Flask(__name__)
+    # The sort payloads are mostly beancount entries, this encodes them directly
+    app.json = DirectJSONProvider(app)
     config = Config()
+    ledger = LedgerCache(config)
+    # Collect runs and sort commits both write to the ledger
+    writer = LedgerWriter()
 
     # Make sure each API is available from other origins
     CORS(app)
+    enable_gzip(app)
 
-    create_config_app(app, config)
-    create_sort_app(app, config)
-    create_collect_app(app, config)
+    create_config_app(app, config, ledger)
+    create_sort_app(app, config, ledger, writer)
+    create_collect_app(app, config, ledger, writer)
 
     return app
@@ -0,0 +1,249 @@
+from collections import Counter
+from difflib import SequenceMatcher
+import os
+from pathlib import Path
+import re
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from beancount.core import account, amount
+from beancount.scripts.format import align_beancount
+
+# Same patterns as beancount.scripts.format.align_beancount, so that we agree on
+# which lines have a number to align, and which lines are postings.
+NUMBER_LINE_RE = re.compile(
+    r'(^\d[^";]*?|\s+{})\s+([-+]?\s*[\d,]+(?:\.\d*)?)\s+({}\b.*)'.format(
+        account.ACCOUNT_RE, amount.CURRENCY_RE
+    )
+)
+POSTING_LINE_RE = re.compile(r"([ \t]+)({}.*)".format(account.ACCOUNT_RE))
+
+# (start, end, new_lines) -- replace lines[start:end] with new_lines
+Edit = Tuple[int, int, List[str]]
+
+# { path => ((mtime_ns, size), widths) }
+_file_widths: Dict[str, Tuple[Tuple[int, int], "ColumnWidths"]] = {}
+_file_widths_lock = Lock()
+
+
+class ColumnWidths:
+    """
+    Everything align_beancount() would compute over a whole file, kept as counts so that
+    lines can be added and removed without re-scanning the file.
+    """
+
+    prefixes: Counter  # { len(prefix) => count } of lines with a number
+    numbers: Counter  # { len(number) => count } of lines with a number
+    indents: Counter  # { len(indent) => count } of posting lines
+    columns: Counter  # { currency column => count } of lines with a number
+
+    def __init__(self) -> None:
+        self.prefixes = Counter()
+        self.numbers = Counter()
+        self.indents = Counter()
+        self.columns = Counter()
+
+    @classmethod
+    def scan(cls, lines: Iterable[str]) -> "ColumnWidths":
+        widths = cls()
+        widths.add(lines)
+        return widths
+
+    def copy(self) -> "ColumnWidths":
+        widths = ColumnWidths()
+        widths.prefixes = self.prefixes.copy()
+        widths.numbers = self.numbers.copy()
+        widths.indents = self.indents.copy()
+        widths.columns = self.columns.copy()
+        return widths
+
+    def add(self, lines: Iterable[str]):
+        self._count(lines, 1)
+
+    def remove(self, lines: Iterable[str]):
+        self._count(lines, -1)
+
+    @property
+    def prefix_width(self) -> int:
+        return max((k for k, v in self.prefixes.items() if v > 0), default=0)
+
+    @property
+    def num_width(self) -> int:
+        return max((k for k, v in self.numbers.items() if v > 0), default=0)
+
+    @property
+    def indent(self) -> int:
+        # Same tie-break as compute_most_frequent(): the widest of the most frequent
+        counts = sorted((v, k) for k, v in self.indents.items() if v > 0)
+        return counts[-1][1] if counts else 0
+
+    def layout(self) -> Tuple[int, int, int]:
+        return (self.prefix_width, self.num_width, self.indent)
+
+    def is_aligned(self) -> bool:
+        """
+        Would align_beancount() leave every line that we've counted untouched?
+        """
+        column = self.prefix_width + 2 + self.num_width
+        indent = self.indent
+        return all(k == column for k, v in self.columns.items() if v > 0) and all(
+            k == indent for k, v in self.indents.items() if v > 0
+        )
+
+    def _count(self, lines: Iterable[str], sign: int):
+        for line in lines:
+            match = NUMBER_LINE_RE.match(line)
+            if match:
+                prefix, number, rest = match.groups()
+                self.prefixes[len(prefix)] += sign
+                self.numbers[len(number)] += sign
+                self.columns[_currency_column(line, prefix, number, rest)] += sign
+            else:
+                prefix = line
+            posting = POSTING_LINE_RE.match(prefix)
+            if posting:
+                self.indents[len(posting.group(1))] += sign
+
+
+def _currency_column(line: str, prefix: str, number: str, rest: str) -> int:
+    # Aligned lines look like: prefix, 2+ spaces, number, 1 space, currency
+    # Anything else is -1, which never matches the column of an aligned file
+    gap = len(line) - len(prefix) - len(number) - len(rest) - 1
+    if gap >= 2 and line == prefix + " " * gap + number + " " + rest:
+        return len(prefix) + gap + len(number)
+    return -1
+
+
+def file_widths(path: Path, lines: List[str]) -> ColumnWidths:
+    """
+    Column widths of the file at $path, whose contents are $lines.
+    Re-uses the widths from the last scan or write, if the file hasn't changed since.
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _file_widths_lock:
+        cached = _file_widths.get(str(path))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    widths = ColumnWidths.scan(lines)
+    with _file_widths_lock:
+        _file_widths[str(path)] = (stamp, widths)
+    return widths
+
+
+def remember_widths(path: Path, widths: ColumnWidths):
+    """
+    Call after writing out the contents that $widths were computed for.
+    """
+    st = os.stat(path)
+    with _file_widths_lock:
+        _file_widths[str(path)] = ((st.st_mtime_ns, st.st_size), widths)
+
+
+def align_edits(
+    lines: List[str], edits: List[Edit], widths: Optional[ColumnWidths] = None
+) -> Tuple[str, ColumnWidths]:
+    """
+    Apply $edits to $lines and align the result the same as align_beancount() would,
+    but only re-formatting the edited lines. Keeping the other lines as they are is only
+    identical to a full align if the file was aligned to begin with, and the edits don't
+    change the column widths. Otherwise this falls back to a full align.
+    Returns the new contents, and the column widths for them.
+    """
+    if widths is None:
+        widths = ColumnWidths.scan(lines)
+    edits = sorted(
+        (start, end, [l for line in new_lines for l in line.splitlines() or [""]])
+        for start, end, new_lines in edits
+    )
+    edited_widths = widths.copy()
+    for start, end, new_lines in edits:
+        edited_widths.remove(lines[start:end])
+        edited_widths.add(new_lines)
+
+    if not widths.is_aligned() or edited_widths.layout() != widths.layout():
+        formatted_output = align_beancount("\n".join(_splice(lines, edits)))
+        return formatted_output, ColumnWidths.scan(formatted_output.splitlines())
+
+    # Only re-format the edited lines
+    prefix_width, num_width, indent = widths.layout()
+    edits = [
+        (
+            start,
+            end,
+            [_align_line(l, prefix_width, num_width, indent) for l in new_lines],
+        )
+        for start, end, new_lines in edits
+    ]
+    new_widths = widths.copy()
+    for start, end, new_lines in edits:
+        new_widths.remove(lines[start:end])
+        new_widths.add(new_lines)
+    output_lines = _splice(lines, edits)
+    # splitlines() in align_beancount() drops a trailing empty line
+    if len(output_lines) > 0 and output_lines[-1] == "":
+        output_lines.pop()
+    return "".join(line + "\n" for line in output_lines), new_widths
+
+
+class EditConflict(RuntimeError):
+    pass
+
+
+def edits_overlap(a: Edit, b: Edit) -> bool:
+    """
+    Two inserts at the same line count, since their order would be arbitrary
+    """
+    return (a[0] < b[1] and b[0] < a[1]) or a[0] == b[0]
+
+
+def rebase_edits(base: List[str], lines: List[str], edits: List[Edit]) -> List[Edit]:
+    """
+    Moves $edits, which were made against $base, onto $lines, which $base has since
+    become. Each edit has to be in a stretch of lines that is the same in both.
+    """
+    if base == lines:
+        return edits
+    same = [
+        (i1, i2, j1 - i1)
+        for tag, i1, i2, j1, _ in SequenceMatcher(None, base, lines).get_opcodes()
+        if tag == "equal"
+    ]
+    rebased = []
+    for start, end, new_lines in edits:
+        shift = next((d for i1, i2, d in same if i1 <= start and end <= i2), None)
+        if shift is None:
+            where = (
+                f"Line {start + 1}" if end - start <= 1 else f"Lines {start + 1}-{end}"
+            )
+            raise EditConflict(f"{where} changed since it was edited")
+        rebased.append((start + shift, end + shift, new_lines))
+    return rebased
+
+
+def _splice(lines: List[str], edits: List[Edit]) -> List[str]:
+    output_lines: List[str] = []
+    prev = 0
+    for start, end, new_lines in edits:
+        assert start >= prev, "Edits must not overlap"
+        output_lines.extend(lines[prev:start])
+        output_lines.extend(new_lines)
+        prev = end
+    output_lines.extend(lines[prev:])
+    return output_lines
+
+
+def _align_line(line: str, prefix_width: int, num_width: int, indent: int) -> str:
+    match = NUMBER_LINE_RE.match(line)
+    if match:
+        prefix, number, rest = match.groups()
+    else:
+        prefix, number, rest = line, None, None
+    posting = POSTING_LINE_RE.match(prefix)
+    if posting:
+        prefix = " " * indent + posting.group(2)
+    if number is None:
+        return prefix
+    return "{:<{}}  {:>{}} {}".format(
+        prefix.rstrip(), prefix_width, number, num_width, rest
+    )
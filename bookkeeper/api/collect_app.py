@@ -1,20 +1,60 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date
+from functools import partial
 import json
 import logging
 from pathlib import Path
-import subprocess
-from typing import Any, List
+from queue import Queue
+from threading import Lock, Semaphore
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from flask import Flask, request, render_template
+from beancount.core.data import Entries
+from flask import Flask, Response, request, render_template
 from plaid import ApiException
 
-from .collect_plaid import PlaidCollector
+from .collect_plaid import PlaidCollector, SyncCursors
 from .collect_editor import LedgerEditor
 from .config_app import Config
-from .serialise import importer_from_dict
+from .ledger_cache import LedgerCache
+from .ledger_writer import LedgerWriter
+from .serialise import Importer, importer_from_dict, to_json
+from .snapshot_store import Manifest, SnapshotStore
+from .utilities import DEFAULT_DIFF_CONTEXT, content_hash, text_diff
 
+MAX_CONCURRENT_IMPORTERS = 4
 
-def create_collect_app(app: Flask, config: Config):
+# Receives the progress events of a collect run
+EventSink = Callable[[Dict[str, Any]], None]
+
+
+class InstitutionLimits:
+    """
+    Caps how many fetches can be in flight against a single institution at a time.
+    """
+
+    _limit: int
+    _semaphores: Dict[str, Semaphore]
+    _lock: Lock
+
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        self._semaphores = {}
+        self._lock = Lock()
+
+    @contextmanager
+    def hold(self, institution_id: str) -> Iterator[None]:
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                institution_id, Semaphore(self._limit)
+            )
+        with semaphore:
+            yield
+
+
+def create_collect_app(
+    app: Flask, config: Config, ledger: LedgerCache, writer: LedgerWriter
+):
     # Needed so that it sees my edits to the template file once this app is running
     app.config["TEMPLATES_AUTO_RELOAD"] = True
 
@@ -56,90 +96,270 @@ def create_collect_app(app: Flask, config: Config):
 
     collector = PlaidCollector(config)
     logging.getLogger().setLevel(logging.INFO)
+    fetchers = ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_IMPORTERS, thread_name_prefix="plaid-fetch"
+    )
+    institution_limits = InstitutionLimits(
+        config["plaid"].get("per-institution-limit", 1)
+    )
+
+    # Replaces the rclone sync into dated directories
+    backups = SnapshotStore(Path("/backups"), Path("/data"))
+
+    cursors = SyncCursors(
+        Path("/data") / config["files"].get("plaid-cursors", ".plaid-cursors.json")
+    )
+
+    def run_importer(
+        mode: str,
+        importer: Importer,
+        start: Optional[date],
+        end: Optional[date],
+        sync: bool = False,
+        events: Optional[EventSink] = None,
+    ) -> Dict[str, Any]:
+        """
+        Fetch from Plaid, then hand the entries off to the writer to insert into the current ledger.
+        With $sync, only fetch what changed since the last sync of this importer.
+        Progress is reported to $events as it happens, if given.
+        """
+        errors: List[str] = []
+        removed: List[str] = []
+
+        def emit(event: str, **fields):
+            if events is not None:
+                events({"event": event, "importer": importer.name, **fields})
+
+        def progress(fetched: int, total: Optional[int]):
+            emit("fetch", fetched=fetched, total=total)
+
+        def insert(account_to_txns: Dict[str, Entries]):
+            # insert and write new file
+            emit("fetched", entries=sum(len(e) for e in account_to_txns.values()))
+            insert_errors = LedgerEditor.insert_many(
+                config, ledger, writer, account_to_txns
+            )
+            errors.extend(insert_errors.values())
+            for account, entries in account_to_txns.items():
+                emit(
+                    "insert",
+                    account=account,
+                    entries=len(entries),
+                    error=insert_errors.get(account),
+                )
+
+        # collect
+        try:
+            fetching = institution_limits.hold(importer.institution_id)
+            if mode == "transactions" and sync:
+                # The cursor only moves on once the txns are safely in the ledger
+                _, removed = collector.sync_into(
+                    importer, cursors, start, insert, progress, fetching
+                )
+            else:
+                with fetching:
+                    if mode == "transactions":
+                        assert start is not None and end is not None
+                        account_to_txns = collector.fetch_transactions(
+                            start, end, importer, progress=progress
+                        )
+                    else:
+                        account_to_txns = collector.fetch_balance(importer)
+                insert(account_to_txns)
+        except ApiException as e:
+            errors.append(str(e.body))
+        if removed:
+            # Might already be booked, so they need to be looked at by hand
+            errors.append(
+                "Removed by Plaid, check they're not in the ledger: {}".format(
+                    ", ".join(removed)
+                )
+            )
+        # return status
+        return {
+            "importer": importer.name,
+            "returncode": len(errors),
+            "errors": errors,
+            "removed": removed,
+        }
+
+    def dates_from_dict(mode: str, item: Any) -> Tuple[Optional[date], Optional[date]]:
+        if mode != "transactions":
+            return None, None
+        return date.fromisoformat(item["start"]), date.fromisoformat(item["end"])
 
     @app.route("/collect/run", methods=["POST"])
     def collect_run():
         """
         Run a Plaid transactions / balance fetch for a particular importer,
         and insert the entries into the current ledger.
+        Body (JSON): mode, importer, start, end, and optionally sync=true to only fetch
+        what changed since the last sync ("start" is then only used on the first sync).
         """
         assert request.json is not None
         mode = request.json["mode"]
         assert mode == "transactions" or mode == "balance"
         importer = importer_from_dict(request.json["importer"])
-        errors: List[str] = []
-        if mode == "transactions":
-            start = date.fromisoformat(request.json["start"])
-            end = date.fromisoformat(request.json["end"])
-            # collect
-            try:
-                account_to_txns = collector.fetch_transactions(start, end, importer)
-            except ApiException as e:
-                errors.append(str(e.body))
-            else:
-                # insert and write new file
-                for account, txns in account_to_txns.items():
-                    try:
-                        LedgerEditor.insert(config, account, txns)
-                    except RuntimeError as re:
-                        errors.append(str(re))
-            # return status
-            return {
-                "importer": importer.name,
-                "returncode": len(errors),
-                "errors": errors,
-            }
-        else:
-            # collect
-            try:
-                account_to_txns = collector.fetch_balance(importer)
-            except ApiException as e:
-                errors.append(str(e.body))
-            else:
-                # insert and write new file
-                for account, txns in account_to_txns.items():
-                    try:
-                        LedgerEditor.insert(config, account, txns)
-                    except RuntimeError as re:
-                        errors.append(str(re))
-            return {
-                "importer": importer.name,
-                "returncode": len(errors),
-                "errors": errors,
-            }
+        start, end = dates_from_dict(mode, request.json)
+        sync = request.json.get("sync", False)
+        return run_importer(mode, importer, start, end, sync)
+
+    @app.route("/collect/run-all", methods=["POST"])
+    def collect_run_all():
+        """
+        Same as /collect/run, but for all the importers at once. The Plaid fetches run
+        concurrently (at most "per-institution-limit" at a time against any one institution),
+        and the inserts into the ledger are serialized.
+        Body (JSON): mode, end, sync, importers -- each importer also has its own "start"
+        """
+        assert request.json is not None
+        futures = submit_importers(request.json)
+        return {"results": [importer_result(name, future) for name, future in futures]}
+
+    @app.route("/collect/run-all/stream", methods=["POST"])
+    def collect_run_all_stream():
+        """
+        Same as /collect/run-all, but streams progress as newline-delimited JSON, one event per line:
+        "fetch" after every page, "fetched" once all pages are in, "insert" per account,
+        and "result" (same as in /collect/run-all) when an importer is done.
+        """
+        assert request.json is not None
+        events: "Queue[Dict[str, Any]]" = Queue()
+        futures = submit_importers(request.json, events.put)
+
+        def on_done(name: str, future: "Future[Dict[str, Any]]"):
+            events.put({"event": "result", **importer_result(name, future)})
+
+        for name, future in futures:
+            future.add_done_callback(partial(on_done, name))
+
+        def generate() -> Iterator[str]:
+            remaining = len(futures)
+            while remaining > 0:
+                event = events.get()
+                if event["event"] == "result":
+                    remaining -= 1
+                yield to_json(event) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    def submit_importers(
+        body: Any, events: Optional[EventSink] = None
+    ) -> List[Tuple[str, "Future[Dict[str, Any]]"]]:
+        """
+        Starts the fetches of all the importers in $body.
+        Returns each importer's name, and the future of its result.
+        """
+        mode = body["mode"]
+        assert mode == "transactions" or mode == "balance"
+        futures = []
+        for item in body["importers"]:
+            importer = importer_from_dict(item)
+            start, end = dates_from_dict(mode, {"end": body.get("end"), **item})
+            future = fetchers.submit(
+                run_importer,
+                mode,
+                importer,
+                start,
+                end,
+                body.get("sync", False),
+                events,
+            )
+            futures.append((importer.name, future))
+        return futures
+
+    def importer_result(name: str, future: "Future[Dict[str, Any]]") -> Dict[str, Any]:
+        """
+        The result of importer $name, or a failed one if it raised (so that the others
+        still get reported)
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            logging.exception("Importer %s failed", name)
+            return {"importer": name, "returncode": 1, "errors": [str(e)]}
 
     @app.route("/collect/backup", methods=["GET", "POST"])
     def collect_backup():
         """
-        Sample command:
-        rclone sync --progress accounts/ backup-accounts/current --backup-dir backup-accounts/`date -I`
+        GET
+        What changed since the last backup: a unified diff of the current ledger, and the
+        files that were added, removed or modified in "changed".
+        Optional args: context -- lines around each change, full=True to also get the full
+        contents of the ledger, before and after.
+
+        POST
+        Takes a new backup (unless nothing changed), then the same as GET.
         """
-        current_dir = Path("/data")
-        backups_dir = Path("/backups")
+        current_ledger = config["files"]["current-ledger"]
         if request.method == "POST":
-            args = [
-                "rclone",
-                "sync",
-                str(current_dir),
-                str(backups_dir / "current"),
-                "--backup-dir",
-                f"{backups_dir}/{date.today().isoformat()}",
-                "--exclude",
-                ".git/",
-                "--exclude",
-                "*.picklecache",
-            ]
-            logging.info(" ".join(args))
-            subprocess.check_call(args)
-        backup_ledger = backups_dir / "current" / config["files"]["current-ledger"]
-        with open(backup_ledger, "r") as backup:
-            old_contents = backup.read()
-        with open(current_dir / config["files"]["current-ledger"], "r") as ledger:
-            new_contents = ledger.read()
-        return {
-            "contents": {"old": old_contents, "new": new_contents},
-            "timestamps": {"last_backup": backup_ledger.stat().st_mtime},
+            latest: Optional[Manifest] = backups.backup()[0]
+        else:
+            latest = backups.latest()
+        with open(Path("/data") / current_ledger, "r") as ledger_file:
+            new_contents = ledger_file.read()
+        changed = backups.changes(latest) if latest is not None else {}
+        if latest is None:
+            old_contents = ""
+        elif current_ledger in changed:
+            old_contents = (backups.read(latest, current_ledger) or b"").decode()
+        else:
+            old_contents = new_contents
+        response = {
+            "diff": text_diff(
+                old_contents,
+                new_contents,
+                current_ledger,
+                request.args.get("context", DEFAULT_DIFF_CONTEXT, type=int),
+            ),
+            "changed": changed,
+            "hashes": {
+                "old": content_hash(old_contents),
+                "new": content_hash(new_contents),
+            },
+            "snapshot": latest["id"] if latest is not None else None,
+            "timestamps": {
+                "last_backup": latest["created"] if latest is not None else None
+            },
         }
+        if request.args.get("full", False):
+            response["contents"] = {"old": old_contents, "new": new_contents}
+        return response
+
+    @app.route("/collect/backup/snapshots")
+    def collect_backup_snapshots():
+        """
+        All the backups, newest first
+        """
+        snapshots = []
+        for id in reversed(backups.snapshots()):
+            manifest = backups.manifest(id)
+            snapshots.append(
+                {
+                    "id": id,
+                    "created": manifest["created"],
+                    "files": sorted(manifest["files"]),
+                }
+            )
+        return {"snapshots": snapshots}
+
+    @app.route("/collect/backup/restore", methods=["POST"])
+    def collect_backup_restore():
+        """
+        Puts the files back the way they were in a backup.
+        Args: snapshot -- id from /collect/backup/snapshots
+        What's there now is backed up first, see "undo" in the response.
+        """
+        id = request.args["snapshot"]
+        ledger_files = [
+            Path("/data") / rel
+            for rel in backups.manifest(id)["files"]
+            if rel.endswith(".beancount")
+        ]
+        # Nothing else writes to the ledger in the meantime
+        with writer.locked(*ledger_files):
+            undo, restored = backups.restore(id)
+        return {"restored": restored, "undo": undo}
 
     @app.route("/collect/last-imported")
     def collect_last_imported():
@@ -147,10 +367,22 @@ def create_collect_app(app: Flask, config: Config):
         return {
             "last": {
                 acc: last.isoformat() if last else None
-                for acc, last in LedgerEditor.last_imported(config, accounts).items()
+                for acc, last in LedgerEditor.last_imported(
+                    config, ledger, accounts
+                ).items()
             }
         }
 
+    @app.route("/collect/metrics")
+    def collect_metrics():
+        """
+        How much the shared Plaid rate limit has been slowing us down.
+        """
+        return {
+            "plaid": collector.limiter.metrics.snapshot(),
+            "rate": collector.limiter.bucket.rate,
+        }
+
     @app.route("/collect/other-importers")
     def collect_other_importers():
         def account_schema(acc):
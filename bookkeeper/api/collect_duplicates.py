@@ -0,0 +1,87 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from beancount.core.data import Directive, Entries, Transaction
+from beancount.ingest.similar import SimilarityComparator, amounts_map
+
+from .utilities import DUPLICATE_META
+
+# Same defaults as beancount.ingest.similar.find_similar_entries()
+DEFAULT_WINDOW_DAYS = 2
+DEFAULT_TOLERANCE = SimilarityComparator.EPSILON
+
+# (account, currency, date)
+BucketKey = Tuple[str, str, date]
+
+
+class DuplicateIndex:
+    """
+    Existing transactions bucketed by (account, currency, date), along with their absolute
+    amount in that bucket. A new transaction is only compared against the transactions in
+    the buckets for its own accounts and dates, and within the amount tolerance.
+    It then uses the same comparator as find_similar_entries(), so flags the same entries.
+    """
+
+    window_days: int
+    tolerance: Decimal
+    _buckets: Dict[BucketKey, List[Tuple[Decimal, Transaction]]]
+
+    def __init__(
+        self,
+        existing_entries: Entries,
+        window_days: int = DEFAULT_WINDOW_DAYS,
+        tolerance: Decimal = DEFAULT_TOLERANCE,
+    ) -> None:
+        self.window_days = window_days
+        self.tolerance = tolerance
+        self._buckets = defaultdict(list)
+        for entry in existing_entries:
+            if type(entry) is not Transaction:
+                continue
+            for (account, currency), number in amounts_map(entry).items():
+                self._buckets[(account, currency, entry.date)].append(
+                    (abs(number), entry)
+                )
+
+    def annotate(self, new_entries: Entries):
+        """
+        Sets DUPLICATE_META on the new entries that look like an existing transaction.
+        """
+        comparator = SimilarityComparator()
+        comparator.EPSILON = self.tolerance
+        for entry in new_entries:
+            if type(entry) is not Transaction:
+                continue
+            if self.find(entry, comparator) is not None:
+                entry.meta[DUPLICATE_META] = True
+
+    def find(
+        self, entry: Transaction, comparator: SimilarityComparator
+    ) -> Optional[Directive]:
+        for candidate in self._candidates(entry):
+            if comparator(entry, candidate):
+                return candidate
+        return None
+
+    def _candidates(self, entry: Transaction) -> List[Transaction]:
+        window = [
+            entry.date + timedelta(days=delta)
+            for delta in range(-self.window_days, self.window_days + 1)
+        ]
+        seen = set()
+        candidates = []
+        for (account, currency), number in amounts_map(entry).items():
+            number = abs(number)
+            # The comparator allows a ratio of (1 + tolerance) either way
+            low = number / (1 + self.tolerance)
+            high = number * (1 + self.tolerance)
+            for day in window:
+                for other, candidate in self._buckets.get(
+                    (account, currency, day), []
+                ):
+                    if low <= other <= high and id(candidate) not in seen:
+                        seen.add(id(candidate))
+                        candidates.append(candidate)
+        return candidates
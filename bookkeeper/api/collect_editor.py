@@ -1,51 +1,110 @@
+from collections import defaultdict
 from datetime import date
+from itertools import chain
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Dict, List, Optional, Tuple, Type
 
-from beancount import loader
-from beancount.core.data import Entries, Balance, Directive
-from beancount.ingest import similar
+from beancount.core.data import Entries, Directive
+from beancount.core.number import D
 from beancount.parser import printer
-from beancount.scripts.format import align_beancount
 
-from .formatting import DISPLAY_CONTEXT, DUPLICATE_META, format_entries
-from .utilities import parse_journal
+from .alignment import Edit
+from .collect_duplicates import DEFAULT_TOLERANCE, DEFAULT_WINDOW_DAYS
+from .formatting import format_entries
+from .ledger_cache import LedgerCache, LedgerSnapshot
+from .ledger_writer import LedgerWriter
 
 
 class LedgerEditor:
     @classmethod
-    def insert(cls, config: Any, account: str, new_entries: Entries):
+    def insert(
+        cls,
+        config: Any,
+        ledger: LedgerCache,
+        writer: LedgerWriter,
+        account: str,
+        new_entries: Entries,
+    ):
         """
         Note that this is static so that there's no state saved between runs, even accidentally.
+        The only shared state is the parsed ledger, which is re-parsed if the files change.
         """
-        # Parse the existing ledger files
-        main_ledger = Path("/data") / config["files"]["main-ledger"]
-        existing_entries = parse_journal(str(main_ledger))
+        errors = cls.insert_many(config, ledger, writer, {account: new_entries})
+        if account in errors:
+            raise RuntimeError(errors[account])
 
-        # Flag the duplicates
-        cls.annotate_duplicate_entries(new_entries, existing_entries)
-
-        # Read in current file
+    @classmethod
+    def insert_many(
+        cls,
+        config: Any,
+        ledger: LedgerCache,
+        writer: LedgerWriter,
+        account_to_entries: Dict[str, Entries],
+    ) -> Dict[str, str]:
+        """
+        Insert the new entries for several accounts with a single parse, format and write.
+        Accounts that can't be inserted are skipped, and their errors are returned.
+        Returns { account => error }
+        """
         current_ledger = Path("/data") / config["files"]["current-ledger"]
-        with open(current_ledger, "r") as dest:
-            destination_lines = dest.read().splitlines()
-
-        # Find the right insertion point
-        lineno = cls.find_insertion_lineno(
-            config, account, new_entries, existing_entries, destination_lines
-        )
-        # -1 since we're going from line number to position, but then +1 for doing this on the next line
-        insert_pos = lineno
-        destination_lines.insert(
-            insert_pos, "\n" + format_entries(new_entries, "").rstrip()
+        written = writer.submit(
+            current_ledger,
+            lambda destination_lines: cls.insertions(
+                config, ledger, account_to_entries, destination_lines
+            ),
         )
+        return written.value
+
+    @classmethod
+    def insertions(
+        cls,
+        config: Any,
+        ledger: LedgerCache,
+        account_to_entries: Dict[str, Entries],
+        destination_lines: List[str],
+    ) -> Tuple[List[Edit], Dict[str, str]]:
+        """
+        The edits to $destination_lines (the current ledger, as it is on disk) that insert
+        the new entries. Returns them, and { account => error }
+        """
+        # Parsed existing ledger files (only re-parsed if they changed on disk)
+        snapshot = ledger.snapshot()
+        # The balances' line numbers are used on $destination_lines, so they have to be from
+        # the same contents. The file is locked, so a new parse is.
+        current_ledger = str(Path("/data") / config["files"]["current-ledger"])
+        if not snapshot.parsed_as_is(current_ledger):
+            ledger.invalidate()
+            snapshot = ledger.snapshot()
+            if not snapshot.parsed_as_is(current_ledger):
+                raise RuntimeError(f"{current_ledger} changed while it was parsed")
 
-        # Run the beancount auto-formatter
-        formatted_output = align_beancount("\n".join(destination_lines))
+        # Flag the duplicates, for all the accounts in one pass
+        cls.annotate_duplicate_entries(
+            config,
+            list(chain.from_iterable(account_to_entries.values())),
+            snapshot,
+        )
 
-        # Write it out
-        with open(current_ledger, "w") as dest:
-            dest.write(formatted_output)
+        # Find the right insertion points, all against the same (unmodified) lines
+        errors: Dict[str, str] = {}
+        insertions: Dict[int, List[str]] = defaultdict(list)
+        for account, new_entries in account_to_entries.items():
+            if len(new_entries) == 0:
+                continue
+            try:
+                lineno = cls.find_insertion_lineno(
+                    config, account, new_entries, snapshot, destination_lines
+                )
+            except RuntimeError as re:
+                errors[account] = str(re)
+                continue
+            # -1 since we're going from line number to position, but then +1 for doing this on the next line
+            insert_pos = lineno
+            insertions[insert_pos].append(
+                "\n" + format_entries(new_entries, "", snapshot.renderer).rstrip()
+            )
+        # The writer runs the beancount auto-formatter, but only over the new entries
+        return [(pos, pos, blocks) for pos, blocks in insertions.items()], errors
 
     @classmethod
     def find_insertion_lineno(
@@ -53,15 +112,14 @@ class LedgerEditor:
         config: Any,
         account: str,
         new_entries: Entries,
-        existing_entries: Entries,
+        snapshot: LedgerSnapshot,
         destination_lines: List[str],
     ) -> int:
         """
         Looks for the last "balance" directive for this account in the destination.
         The assumption (which is safe in my journal) is that each account ends its dedicated section with a "balance" entry.
-        "destination_entries" itself is a date-ordered list of directives.
         """
-        bal = cls.find_last_balance(config, account, existing_entries)
+        bal = cls.find_last_balance(config, account, snapshot)
         if bal:
             if len(new_entries) == 1 and bal.date == new_entries[0].date:
                 raise RuntimeError(f"No new updates for {account}")
@@ -74,51 +132,42 @@ class LedgerEditor:
     def last_imported(
         cls,
         config: Any,
+        ledger: LedgerCache,
         accounts: List[str],
     ) -> Dict[str, Optional[date]]:
-        main_ledger = Path("/data") / config["files"]["main-ledger"]
-        existing_entries = parse_journal(str(main_ledger))
+        snapshot = ledger.snapshot()
 
         def last(account):
-            bal = cls.find_last_balance(config, account, existing_entries)
+            bal = cls.find_last_balance(config, account, snapshot)
             return bal.date if bal else None
 
         return {account: last(account) for account in accounts}
 
     @classmethod
     def find_last_balance(
-        cls, config: Any, account: str, existing_entries: Entries
+        cls, config: Any, account: str, snapshot: LedgerSnapshot
     ) -> Optional[Directive]:
-        matching_balances = [
-            entry
-            for entry in existing_entries
-            if type(entry) is Balance
-            and account == entry.account
-            and Path(entry.meta["filename"]).name == config["files"]["current-ledger"]
-        ]
-        if len(matching_balances) == 0:
-            return None
-        else:
-            newest_balance = max(
-                matching_balances,
-                key=lambda entry: entry.date,
-            )
-            return newest_balance
+        """
+        Newest balance for this account in the current ledger file.
+        The index is rebuilt whenever the ledger is re-parsed, so it reflects every insert.
+        """
+        return snapshot.balances.last(config["files"]["current-ledger"], account)
 
     @classmethod
-    def annotate_duplicate_entries(cls, new_entries, existing_entries):
+    def annotate_duplicate_entries(
+        cls, config: Any, new_entries: Entries, snapshot: LedgerSnapshot
+    ):
         """Flag potentially duplicate entries.
         Args:
-        new_entries: A list of lists of imported entries, one for each
-            importer.
+        new_entries: A list of imported entries.
+        snapshot: The existing ledger, whose DuplicateIndex is built on first use.
         Returns:
         Modifies new_entries in-place, potentially with
             modified metadata to indicate those which are duplicated.
         """
-        # Find similar entries against the existing ledger only.
-        duplicate_pairs = similar.find_similar_entries(new_entries, existing_entries)
-        # Add a metadata marker to the extracted entries for duplicates.
-        duplicate_set = set(id(entry) for entry, _ in duplicate_pairs)
-        for entry in new_entries:
-            if id(entry) in duplicate_set:
-                entry.meta[DUPLICATE_META] = True
+        options = config.get("duplicates", {})
+        index = snapshot.duplicates(
+            window_days=options.get("window-days", DEFAULT_WINDOW_DAYS),
+            tolerance=D(str(options.get("tolerance", DEFAULT_TOLERANCE))),
+        )
+        index.annotate(new_entries)
@@ -1,8 +1,21 @@
+from collections import defaultdict
+from contextlib import nullcontext
 from datetime import date, timedelta
+from decimal import Decimal
 import json
 import logging
-from typing import Any, Dict, List
-from time import sleep
+from pathlib import Path
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
 from beancount.core import flags
 from beancount.core.number import D
@@ -19,20 +32,32 @@ from plaid.model.transaction import Transaction as PlaidTransaction
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
 from plaid.model.transactions_get_response import TransactionsGetResponse
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+from plaid.model.transactions_sync_response import TransactionsSyncResponse
 
+from .collect_ratelimit import PlaidRateLimiter
 from .serialise import Importer
-from .utilities import TODO_ACCOUNT
-
+from .utilities import TODO_ACCOUNT, write_atomically
 
 NET_WORTH_SYNC = "Equity:Net-Worth-Sync"
+# Most that /transactions/sync allows per page
+SYNC_PAGE_SIZE = 500
+# How many times to start a sync over, when the transactions change while paging
+SYNC_MAX_RESTARTS = 3
+
+# Called after every page with (transactions fetched so far, total if known)
+ProgressCallback = Callable[[int, Optional[int]], None]
+T = TypeVar("T")
 
 
 class PlaidCollector:
     client: PlaidApi
+    limiter: PlaidRateLimiter
 
     def __init__(self, config: Any) -> None:
         configuration = Configuration(
-            host=Environment.Development,
+            # Can be pointed at a local stand-in for Plaid
+            host=config["plaid"].get("host", Environment.Development),
             api_key={
                 "clientId": config["plaid"]["client-id"],
                 "secret": config["plaid"]["secret"],
@@ -41,9 +66,15 @@ class PlaidCollector:
         )
         api_client = ApiClient(configuration)
         self.client = PlaidApi(api_client)
+        # Shared by every fetch in this process
+        self.limiter = PlaidRateLimiter.from_config(config)
 
     def fetch_transactions(
-        self, start: date, end: date, importer: Importer
+        self,
+        start: date,
+        end: date,
+        importer: Importer,
+        progress: Optional[ProgressCallback] = None,
     ) -> Dict[str, Entries]:
         # the transactions in the response are paginated, so make multiple calls while increasing the offset to
         # retrieve all transactions
@@ -64,9 +95,9 @@ class PlaidCollector:
                     f"{importer.name}: %s",
                     json.dumps(req.to_dict(), indent=2, sort_keys=True, default=str),
                 )
-                if opts.offset > 0:
-                    sleep(1)  # seconds. To avoid hitting Plaid rate limits.
-                response: TransactionsGetResponse = self.client.transactions_get(req)
+                response: TransactionsGetResponse = self.limiter.call(
+                    importer.name, lambda: self.client.transactions_get(req)
+                )
             except ApiException as e:
                 logging.warning("Plaid error: %s", e.body)
                 raise e
@@ -77,6 +108,8 @@ class PlaidCollector:
             logging.info(
                 f"{importer.name}: Fetched {len(response.transactions)} transactions ({len(transactions)} of {total_transactions})"
             )
+            if progress is not None:
+                progress(len(transactions), total_transactions)
             logging.debug(
                 "> RAW FETCHED TXNS: %s",
                 json.dumps(response.to_dict(), indent=2, sort_keys=True, default=str),
@@ -87,122 +120,200 @@ class PlaidCollector:
                 )
                 break
 
-        def construct_ledger(account_meta) -> Entries:
-            assert first_response is not None
-            # find the matching account in Plaid response
-            account: AccountBase = next(
-                acc
-                for acc in first_response.accounts
-                if acc.account_id == account_meta.plaid_id
+        assert first_response is not None
+        return self._construct_ledgers(
+            importer,
+            first_response.accounts,
+            transactions,
+            with_balance=end == date.today(),
+        )
+
+    def sync_transactions(
+        self,
+        importer: Importer,
+        cursor: Optional[str],
+        start: Optional[date] = None,
+        progress: Optional[ProgressCallback] = None,
+    ) -> Tuple[Dict[str, Entries], str, List[str]]:
+        """
+        Incremental fetch with Plaid's /transactions/sync. Only pulls what was added, modified
+        or removed since $cursor. Returns the entries, the cursor to use next time, and the
+        ids of the removed transactions that might be in the ledger already.
+        On the first sync (no cursor) Plaid sends the whole history, so that is cut off at $start.
+        """
+        restarts = 0
+        while True:
+            try:
+                added, removed, next_cursor = self._sync_pages(
+                    importer, cursor, progress
+                )
+                break
+            except ApiException as e:
+                if (
+                    _error_code(e) != "TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION"
+                    or restarts >= SYNC_MAX_RESTARTS
+                ):
+                    raise e
+                # The pages fetched so far can't be trusted, Plaid wants it all again
+                restarts += 1
+                logging.info(
+                    f"{importer.name}: Changed while syncing, starting over from the cursor"
+                )
+        # Pending transactions are skipped, so it's only a problem if a posted one was removed.
+        # Once a pending transaction posts, Plaid removes it and adds the posted one.
+        not_booked = {txn.transaction_id for txn in added if txn.pending}
+        not_booked.update(
+            txn.pending_transaction_id
+            for txn in added
+            if txn.get("pending_transaction_id")
+        )
+        removed = [id for id in removed if id not in not_booked]
+        if removed:
+            logging.warning(
+                f"{importer.name}: {len(removed)} transactions removed: %s", removed
+            )
+        if start is not None:
+            added = [txn for txn in added if txn["date"] >= start]
+        # Sorted newest first, same as /transactions/get
+        added.sort(key=lambda txn: txn["date"], reverse=True)
+        accounts = self._fetch_accounts(importer).accounts
+        return (
+            self._construct_ledgers(importer, accounts, added, with_balance=True),
+            next_cursor,
+            removed,
+        )
+
+    def sync_into(
+        self,
+        importer: Importer,
+        cursors: "SyncCursors",
+        start: Optional[date],
+        insert: Callable[[Dict[str, Entries]], T],
+        progress: Optional[ProgressCallback] = None,
+        fetching: ContextManager[Any] = nullcontext(),
+    ) -> Tuple[T, List[str]]:
+        """
+        Syncs $importer from its saved cursor, and hands the entries to $insert. The new
+        cursor is only saved once $insert returns, so if it raises, the next sync fetches
+        the same transactions again. $start is only used on the first sync, and $fetching
+        is held while talking to Plaid (but not during the $insert).
+        Returns what $insert did, and the removed transactions (see sync_transactions())
+        """
+        cursor = cursors.get(importer.name)
+        with fetching:
+            account_to_txns, next_cursor, removed = self.sync_transactions(
+                importer,
+                cursor,
+                start=start if cursor is None else None,
+                progress=progress,
             )
+        inserted = insert(account_to_txns)
+        cursors.save(importer.name, next_cursor)
+        return inserted, removed
+
+    def _sync_pages(
+        self,
+        importer: Importer,
+        cursor: Optional[str],
+        progress: Optional[ProgressCallback],
+    ) -> Tuple[List[PlaidTransaction], List[str], str]:
+        """
+        All the pages of /transactions/sync from $cursor.
+        Returns the added (and modified) transactions, the removed ids, and the next cursor
+        """
+        added: List[PlaidTransaction] = []
+        removed: List[str] = []
+        has_more = True
+        while has_more:
+            try:
+                req = TransactionsSyncRequest(
+                    access_token=importer.access_token, count=SYNC_PAGE_SIZE
+                )
+                if cursor:
+                    req.cursor = cursor
+                logging.info(
+                    f"{importer.name}: %s",
+                    json.dumps(req.to_dict(), indent=2, sort_keys=True, default=str),
+                )
+                response: TransactionsSyncResponse = self.limiter.call(
+                    importer.name, lambda: self.client.transactions_sync(req)
+                )
+            except ApiException as e:
+                logging.warning("Plaid error: %s", e.body)
+                raise e
+            # Modified transactions are re-inserted, and left to duplicate detection
+            added.extend(response.added)
+            added.extend(response.modified)
+            removed.extend(txn.transaction_id for txn in response.removed)
+            cursor = response.next_cursor
+            has_more = response.has_more
+            logging.info(
+                f"{importer.name}: Synced {len(response.added)} added, {len(response.modified)} modified, {len(response.removed)} removed"
+            )
+            if progress is not None:
+                # Plaid doesn't say how many there are in total
+                progress(len(added), None)
+        if cursor is None:
+            raise RuntimeError(f"No cursor from Plaid for {importer.name}")
+        return added, removed, cursor
+
+    def _construct_ledgers(
+        self,
+        importer: Importer,
+        accounts: List[AccountBase],
+        transactions: List[PlaidTransaction],
+        with_balance: bool,
+    ) -> Dict[str, Entries]:
+        end = date.today()
+        # { plaid account_id => [ledger account meta] }
+        wanted: Dict[str, List[Any]] = defaultdict(list)
+        ledgers: Dict[str, Entries] = {}
+        for account_meta in importer.accounts:
+            wanted[account_meta.plaid_id].append(account_meta)
+            ledgers[account_meta.name] = []
+
+        # Single pass over the transactions, straight into the ledger for each account
+        for transaction in transactions:
+            if transaction.pending:
+                # we want to wait for the transaction to be posted
+                continue
+            for account_meta in wanted.get(transaction.account_id, []):
+                assert account_meta.currency == transaction.iso_currency_code
+                ledgers[account_meta.name].append(
+                    _transaction_entry(account_meta, transaction)
+                )
+
+        for account_meta, account in _resolve_accounts(importer, accounts):
+            ledger = ledgers[account_meta.name]
             if account is None:
-                logging.warning("Not present in response: %s", account_meta.name)
-                return []
-            currency = account_meta.currency
-            ledger = []
-            for transaction in transactions:
-                if account.account_id != transaction.account_id:
-                    continue
-                assert currency == transaction.iso_currency_code
-                if transaction.pending:
-                    # we want to wait for the transaction to be posted
-                    continue
-                amount = D(transaction.amount)
-                assert amount is not None
-                # sadly, plaid-python parses as `float` https://github.com/plaid/plaid-python/issues/136
-                amount = round(amount, 2)
-                postings = [
-                    Posting(
-                        account=account_meta.name,
-                        units=Amount(-amount, currency),
-                        cost=None,
-                        price=None,
-                        flag=None,
-                        meta=None,
-                    ),
-                    Posting(
-                        account=TODO_ACCOUNT,
-                        # In practice, beancount libs are fine with this
-                        units=None,  # type: ignore
-                        cost=None,
-                        price=None,
-                        flag=None,
-                        meta=None,
-                    ),
-                ]
+                ledger.clear()
+                continue
+            ledger.reverse()  # API returns transactions in reverse chronological order
+            # (maybe) add the balance directive
+            if with_balance:
                 meta = data.new_metadata("foo", 0)
-                entry = Transaction._make(
+                entry = Balance._make(
                     [
                         meta,
-                        transaction["date"],
-                        flags.FLAG_OKAY,
-                        transaction["name"],  # payee
-                        "",  # narration
-                        data.EMPTY_SET,  # tags
-                        data.EMPTY_SET,  # links
-                        postings,
+                        end,
+                        account_meta.name,
+                        Amount(_current_balance(account), account_meta.currency),
+                        None,  # tolerance
+                        None,  # diff_amount
                     ]
                 )
                 ledger.append(entry)
-            ledger.reverse()  # API returns transactions in reverse chronological order
 
-            # (maybe) add the balance directive
-            if end == date.today():
-                bal = D(account.balances.current)
-                if bal != None:
-                    # sadly, plaid-python parses as `float` https://github.com/plaid/plaid-python/issues/136
-                    bal = round(bal, 2)
-                    if account.type in [AccountType("credit"), AccountType("loan")]:
-                        # the balance is a liability in the case of credit cards, and loans
-                        # https://plaid.com/docs/#account-types
-                        bal = -bal
-                    meta = data.new_metadata("foo", 0)
-                    entry = Balance._make(
-                        [
-                            meta,
-                            end,
-                            account_meta.name,
-                            Amount(bal, currency),
-                            None,  # tolerance
-                            None,  # diff_amount
-                        ]
-                    )
-                    ledger.append(entry)
-
-            return ledger
-
-        return {acc.name: construct_ledger(acc) for acc in importer.accounts}
+        return ledgers
 
     def fetch_balance(self, importer: Importer) -> Dict[str, Entries]:
-        try:
-            req = AccountsGetRequest(access_token=importer.access_token)
-            logging.info(
-                f"{importer.name}: %s",
-                json.dumps(req.to_dict(), indent=2, sort_keys=True, default=str),
-            )
-            response: AccountsGetResponse = self.client.accounts_get(req)
-        except ApiException as e:
-            logging.warning("Plaid error: %s", e.body)
-            raise e
+        response = self._fetch_accounts(importer)
 
-        def pad_and_balance(account_meta) -> Entries:
-            account: AccountBase = next(
-                acc
-                for acc in response.accounts
-                if acc.account_id == account_meta.plaid_id
-            )
+        def pad_and_balance(account_meta, account: Optional[AccountBase]) -> Entries:
             if account is None:
-                logging.warning("Not present in response: %s", account_meta.name)
                 return []
-            currency = account_meta.currency
-            bal = D(account.balances.current)
-            if bal != None and (bal < 0 or bal > 0):
-                # sadly, plaid-python parses as `float` https://github.com/plaid/plaid-python/issues/136
-                bal = round(bal, 2)
-                if account.type in [AccountType("credit"), AccountType("loan")]:
-                    # the balance is a liability in the case of credit cards, and loans
-                    # https://plaid.com/docs/#account-types
-                    bal = -bal
+            bal = _current_balance(account)
+            if bal < 0 or bal > 0:
                 meta = data.new_metadata("foo", 0)
                 return [
                     Pad._make(
@@ -218,7 +329,7 @@ class PlaidCollector:
                             meta,
                             date.today(),
                             account_meta.name,
-                            Amount(bal, currency),
+                            Amount(bal, account_meta.currency),
                             None,  # tolerance
                             None,  # diff_amount
                         ]
@@ -227,4 +338,124 @@ class PlaidCollector:
 
             return []
 
-        return {acc.name: pad_and_balance(acc) for acc in importer.accounts}
+        return {
+            account_meta.name: pad_and_balance(account_meta, account)
+            for account_meta, account in _resolve_accounts(importer, response.accounts)
+        }
+
+    def _fetch_accounts(self, importer: Importer) -> AccountsGetResponse:
+        try:
+            req = AccountsGetRequest(access_token=importer.access_token)
+            logging.info(
+                f"{importer.name}: %s",
+                json.dumps(req.to_dict(), indent=2, sort_keys=True, default=str),
+            )
+            response: AccountsGetResponse = self.limiter.call(
+                importer.name, lambda: self.client.accounts_get(req)
+            )
+        except ApiException as e:
+            logging.warning("Plaid error: %s", e.body)
+            raise e
+        return response
+
+
+def _resolve_accounts(
+    importer: Importer, accounts: List[AccountBase]
+) -> List[Tuple[Any, Optional[AccountBase]]]:
+    """
+    Pairs each of the importer's accounts with the matching account in the Plaid response.
+    """
+    by_id = {acc.account_id: acc for acc in accounts}
+    resolved = []
+    for account_meta in importer.accounts:
+        account = by_id.get(account_meta.plaid_id)
+        if account is None:
+            logging.warning("Not present in response: %s", account_meta.name)
+        resolved.append((account_meta, account))
+    return resolved
+
+
+def _error_code(e: ApiException) -> Optional[str]:
+    try:
+        return json.loads(e.body).get("error_code")
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _current_balance(account: AccountBase) -> Decimal:
+    # sadly, plaid-python parses as `float` https://github.com/plaid/plaid-python/issues/136
+    bal = round(D(account.balances.current), 2)
+    if account.type in [AccountType("credit"), AccountType("loan")]:
+        # the balance is a liability in the case of credit cards, and loans
+        # https://plaid.com/docs/#account-types
+        bal = -bal
+    return bal
+
+
+def _transaction_entry(account_meta, transaction: PlaidTransaction) -> Transaction:
+    currency = account_meta.currency
+    amount = D(transaction.amount)
+    assert amount is not None
+    # sadly, plaid-python parses as `float` https://github.com/plaid/plaid-python/issues/136
+    amount = round(amount, 2)
+    postings = [
+        Posting(
+            account=account_meta.name,
+            units=Amount(-amount, currency),
+            cost=None,
+            price=None,
+            flag=None,
+            meta=None,
+        ),
+        Posting(
+            account=TODO_ACCOUNT,
+            # In practice, beancount libs are fine with this
+            units=None,  # type: ignore
+            cost=None,
+            price=None,
+            flag=None,
+            meta=None,
+        ),
+    ]
+    meta = data.new_metadata("foo", 0)
+    return Transaction._make(
+        [
+            meta,
+            transaction["date"],
+            flags.FLAG_OKAY,
+            transaction["name"],  # payee
+            "",  # narration
+            data.EMPTY_SET,  # tags
+            data.EMPTY_SET,  # links
+            postings,
+        ]
+    )
+
+
+class SyncCursors:
+    """
+    The last /transactions/sync cursor for each importer, kept in a JSON file next to the ledger.
+    """
+
+    _path: Path
+    _lock: Lock
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = Lock()
+
+    def get(self, importer: str) -> Optional[str]:
+        with self._lock:
+            return self._read().get(importer)
+
+    def save(self, importer: str, cursor: str):
+        with self._lock:
+            cursors = self._read()
+            cursors[importer] = cursor
+            write_atomically(self._path, json.dumps(cursors, indent=2, sort_keys=True))
+
+    def _read(self) -> Dict[str, str]:
+        if not self._path.exists():
+            return {}
+        with open(self._path) as f:
+            return json.load(f)
@@ -0,0 +1,186 @@
+import json
+import logging
+import random
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from plaid import ApiException
+
+T = TypeVar("T")
+
+DEFAULT_RATE = 2.0  # requests per second, across all importers
+DEFAULT_BURST = 4
+DEFAULT_MAX_RETRIES = 5
+# seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+# Don't slow down below this when Plaid keeps pushing back
+MIN_RATE = 0.1
+
+
+class PlaidMetrics:
+    """
+    Counters for the Plaid calls made by this process. Safe to bump from any thread.
+    """
+
+    _counts: Dict[str, float]
+    _lock: Lock
+
+    def __init__(self) -> None:
+        self._counts = {
+            "requests": 0,
+            "throttled": 0,  # requests that had to wait for a token
+            "throttled_seconds": 0.0,
+            "retries": 0,
+            "retry_seconds": 0.0,
+            "rate_limited": 0,  # 429 or RATE_LIMIT_EXCEEDED responses
+            "server_errors": 0,  # 5xx responses
+            "failures": 0,  # gave up, and raised to the caller
+        }
+        self._lock = Lock()
+
+    def bump(self, name: str, by: float = 1):
+        with self._lock:
+            self._counts[name] += by
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class TokenBucket:
+    """
+    Lets through up to $burst calls at once, refilled at $rate per second.
+    The rate adapts: it halves whenever Plaid rate-limits us, and creeps back up
+    to the configured rate with every successful call.
+    """
+
+    max_rate: float
+    rate: float
+    burst: float
+    _tokens: float
+    _updated: float
+    _lock: Lock
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available. Returns how long it waited, in seconds.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+            waited += wait
+
+    def slow_down(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+            # Don't let a burst through right after being told off
+            self._tokens = min(self._tokens, 0)
+
+    def speed_up(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class PlaidRateLimiter:
+    """
+    Every Plaid call in the process goes through call(), so that they share a rate limit.
+    Rate limit and server errors are retried with exponential backoff and full jitter.
+    """
+
+    bucket: TokenBucket
+    metrics: PlaidMetrics
+    max_retries: int
+
+    def __init__(
+        self,
+        rate: float = DEFAULT_RATE,
+        burst: float = DEFAULT_BURST,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        self.metrics = PlaidMetrics()
+        self.max_retries = max_retries
+
+    @classmethod
+    def from_config(cls, config: Any) -> "PlaidRateLimiter":
+        limits = config["plaid"].get("rate-limit", {})
+        return cls(
+            rate=float(limits.get("requests-per-second", DEFAULT_RATE)),
+            burst=float(limits.get("burst", DEFAULT_BURST)),
+            max_retries=int(limits.get("max-retries", DEFAULT_MAX_RETRIES)),
+        )
+
+    def call(self, name: str, fn: Callable[[], T]) -> T:
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            if waited > 0:
+                self.metrics.bump("throttled")
+                self.metrics.bump("throttled_seconds", waited)
+            self.metrics.bump("requests")
+            try:
+                response = fn()
+            except ApiException as e:
+                retryable = self._classify(e)
+                if not retryable or attempt >= self.max_retries:
+                    self.metrics.bump("failures")
+                    raise e
+                backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+                attempt += 1
+                logging.warning(
+                    "%s: Plaid error %s, retry %d of %d in %.1fs",
+                    name,
+                    e.status,
+                    attempt,
+                    self.max_retries,
+                    backoff,
+                )
+                self.metrics.bump("retries")
+                self.metrics.bump("retry_seconds", backoff)
+                sleep(backoff)
+                continue
+            self.bucket.speed_up()
+            return response
+
+    def _classify(self, e: ApiException) -> bool:
+        """
+        Is $e worth retrying? Also slows the bucket down if we were rate limited.
+        """
+        if e.status == 429 or _error_type(e) == "RATE_LIMIT_EXCEEDED":
+            self.metrics.bump("rate_limited")
+            self.bucket.slow_down()
+            return True
+        if e.status is not None and 500 <= e.status < 600:
+            self.metrics.bump("server_errors")
+            return True
+        return False
+
+
+def _error_type(e: ApiException) -> Optional[str]:
+    try:
+        return json.loads(e.body).get("error_type")
+    except (TypeError, ValueError, AttributeError):
+        return None
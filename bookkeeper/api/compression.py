@@ -0,0 +1,31 @@
+import gzip
+
+from flask import Flask, Response, request
+
+# Not worth compressing anything smaller than this, in bytes
+GZIP_MIN_SIZE = 1024
+
+
+def enable_gzip(app: Flask):
+    """
+    Gzip the responses for clients that accept it. Streamed responses are left alone,
+    so that each chunk still reaches the client as soon as it is sent.
+    """
+
+    @app.after_request
+    def gzip_response(response: Response) -> Response:
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or not 200 <= response.status_code < 300
+            or "Content-Encoding" in response.headers
+            or "gzip" not in request.headers.get("Accept-Encoding", "").lower()
+        ):
+            return response
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+        response.vary.add("Accept-Encoding")
+        return response
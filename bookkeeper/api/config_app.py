@@ -1,12 +1,17 @@
 from typing import Any
 
+from beancount.parser import printer
 from flask import Flask
 import yaml
 
+from .ledger_cache import LedgerCache
+from .sort_categories import PayeeMatcher
+
 
 class Config:
 
     _data: Any
+    categories: PayeeMatcher
 
     def __init__(self) -> None:
         self.reload()
@@ -14,12 +19,16 @@ class Config:
     def reload(self):
         with open("/data/CONFIG.yaml") as f:
             self._data = yaml.full_load(f)
+        self.categories = PayeeMatcher(self._data.get("categories") or {})
 
     def __getitem__(self, k: str):
         return self._data[k]
 
+    def get(self, k: str, default: Any = None):
+        return self._data.get(k, default)
+
 
-def create_config_app(app: Flask, config: Config):
+def create_config_app(app: Flask, config: Config, ledger: LedgerCache):
     """
     Config-related endpoints
     """
@@ -27,7 +36,21 @@ def create_config_app(app: Flask, config: Config):
     @app.route("/config/reload", methods=["POST"])
     def config_reload():
         """
-        Reload config from disk
+        Reload config from disk, and force the ledger to be re-parsed on next use
         """
         config.reload()
+        ledger.invalidate()
         return {"success": True}
+
+    @app.route("/config/ledger")
+    def config_ledger():
+        """
+        Parse errors and options from the last load of the main ledger
+        """
+        snapshot = ledger.snapshot()
+        return {
+            "main_file": snapshot.main_ledger,
+            "include": snapshot.options_map["include"],
+            "operating_currency": snapshot.options_map["operating_currency"],
+            "errors": [printer.format_error(error) for error in snapshot.errors],
+        }
@@ -1,28 +1,137 @@
+from collections import OrderedDict
+from decimal import Decimal
 from io import StringIO
 import textwrap
-from typing import Set
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
-from beancount.core.display_context import DisplayContext
+from beancount.core.display_context import DisplayContext, Precision
 from beancount.parser import printer
 from beancount.core.data import (
+    Balance,
+    Directive,
     Entries,
     Posting,
+    Transaction,
 )
 
 from .utilities import DUPLICATE_META
 
+# Numbers as they are, for when the ledger hasn't been loaded
 DISPLAY_CONTEXT = DisplayContext()
 DISPLAY_CONTEXT.set_commas(True)
 
+# How many rendered entries to remember
+RENDER_CACHE_SIZE = 4096
 
-def format_entries(entries: Entries, indent: str) -> str:
+
+def ledger_display_context(options_map: Dict[str, Any]) -> DisplayContext:
+    """
+    The precision that the ledger itself uses for each currency, with commas
+    """
+    dcontext = DisplayContext()
+    dcontext.update_from(options_map["dcontext"])
+    dcontext.set_commas(True)
+    return dcontext
+
+
+class EntryRenderer:
+    """
+    Renders entries the way printer.format_entry() does, but with the one EntryPrinter.
+    Remembers the text of the most recently rendered entries, by what's in them (entries
+    are rebuilt with _replace() all the time), and the entry objects it has already
+    seen, so re-rendering an unchanged entry is a lookup.
+    """
+
+    dcontext: DisplayContext
+    _printer: printer.EntryPrinter
+    _natural: printer.EntryPrinter
+    _rendered: "OrderedDict[Tuple[str, str], str]"  # { (indent, repr(entry)) => text }
+    # { (indent, id(entry)) => (entry, key in _rendered) }
+    _seen: "OrderedDict[Tuple[str, int], Tuple[Directive, Tuple[str, str]]]"
+    _lock: Lock
+
+    def __init__(self, dcontext: DisplayContext = DISPLAY_CONTEXT) -> None:
+        self.dcontext = dcontext
+        self._printer = printer.EntryPrinter(dcontext)
+        self._natural = printer.EntryPrinter(DISPLAY_CONTEXT)
+        self._rendered = OrderedDict()
+        self._seen = OrderedDict()
+        self._lock = Lock()
+
+    def render(self, entry: Directive, indent: str = "") -> str:
+        seen_key = (indent, id(entry))
+        with self._lock:
+            # Holding on to the entry, so its id can't be reused while it's in here
+            seen = self._seen.get(seen_key)
+            if seen is not None and seen[0] is entry:
+                text = self._rendered.get(seen[1])
+                if text is not None:
+                    self._seen.move_to_end(seen_key)
+                    self._rendered.move_to_end(seen[1])
+                    return text
+        # repr() tells 1.0 and 1.00 apart, and is a lot cheaper than printing
+        key = (indent, repr(entry))
+        with self._lock:
+            text = self._rendered.get(key)
+        if text is None:
+            text = self._printer(entry) if self._fits(entry) else self._natural(entry)
+            if indent:
+                text = textwrap.indent(text, indent)
+        with self._lock:
+            self._rendered[key] = text
+            self._rendered.move_to_end(key)
+            self._seen[seen_key] = (entry, key)
+            for lru in (self._rendered, self._seen):
+                while len(lru) > RENDER_CACHE_SIZE:
+                    lru.popitem(last=False)
+        return text
+
+    def render_all(self, entries: Entries, indent: str = "") -> List[str]:
+        return [self.render(entry, indent) for entry in entries]
+
+    def _fits(self, entry: Directive) -> bool:
+        """
+        Numbers are shown with the ledger's most common precision for their currency, so
+        check that this doesn't round off any digits
+        """
+        for number, currency in _numbers(entry):
+            ccontext = self.dcontext.ccontexts.get(currency)
+            if ccontext is None:
+                continue
+            fractional = ccontext.get_fractional(Precision.MOST_COMMON)
+            if fractional is None:
+                continue
+            exponent = number.as_tuple().exponent
+            if isinstance(exponent, int) and -exponent > fractional:
+                return False
+        return True
+
+
+def _numbers(entry: Directive) -> Iterator[Tuple[Decimal, str]]:
+    if type(entry) is Transaction:
+        for posting in entry.postings:
+            for amount in (posting.units, posting.cost, posting.price):
+                number = getattr(amount, "number", None)
+                if isinstance(number, Decimal):
+                    yield number, amount.currency
+    elif type(entry) is Balance and entry.amount.number is not None:
+        yield entry.amount.number, entry.amount.currency
+
+
+DEFAULT_RENDERER = EntryRenderer()
+
+
+def format_entries(
+    entries: Entries, indent: str, renderer: Optional[EntryRenderer] = None
+) -> str:
+    renderer = renderer or DEFAULT_RENDERER
     outf = StringIO()
-    for entry in entries:
-        outs = printer.format_entry(entry, DISPLAY_CONTEXT)
+    for entry, outs in zip(entries, renderer.render_all(entries)):
         if DUPLICATE_META in entry.meta:
             # Make it a comment
             outs = textwrap.indent(outs, "; ")
-        outf.write(textwrap.indent(outs, indent))
+        outf.write(textwrap.indent(outs, indent) if indent else outs)
         outf.write("\n")  # add a newline
     return outf.getvalue()
 
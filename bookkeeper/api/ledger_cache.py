@@ -0,0 +1,213 @@
+from dataclasses import dataclass
+from decimal import Decimal
+from hashlib import sha1
+import logging
+import os
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from beancount import loader
+from beancount.core.data import Balance, Entries
+
+from .collect_duplicates import DuplicateIndex
+from .formatting import EntryRenderer, ledger_display_context
+
+
+@dataclass(frozen=True)
+class FileStamp:
+    """
+    What we know about an included file at the time it was parsed.
+    """
+
+    mtime_ns: int
+    size: int
+    digest: str
+
+
+# Never matches a file, so that the next snapshot() parses again
+STALE = FileStamp(mtime_ns=-1, size=-1, digest="")
+# How far behind the clock the mtime of a file written just now can be
+MTIME_SLACK_NS = 100_000_000
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return sha1(f.read()).hexdigest()
+
+
+def _stamp(path: str) -> FileStamp:
+    st = os.stat(path)
+    return FileStamp(
+        mtime_ns=st.st_mtime_ns, size=st.st_size, digest=file_digest(path)
+    )
+
+
+def _try_stamp(path: str) -> Optional[FileStamp]:
+    try:
+        return _stamp(path)
+    except FileNotFoundError:
+        return None
+
+
+class BalanceIndex:
+    """
+    The newest Balance directive for each account, per file. Built in a single pass.
+    """
+
+    _latest: Dict[str, Dict[str, Balance]]  # { file name => { account => balance } }
+
+    def __init__(self, entries: Entries) -> None:
+        self._latest = {}
+        names: Dict[str, str] = {}  # { filename => file name }
+        for entry in entries:
+            if type(entry) is not Balance:
+                continue
+            filename = entry.meta["filename"]
+            name = names.get(filename)
+            if name is None:
+                name = names[filename] = Path(filename).name
+            latest = self._latest.setdefault(name, {})
+            prev = latest.get(entry.account)
+            if prev is None or entry.date > prev.date:
+                latest[entry.account] = entry
+
+    def last(self, file_name: str, account: str) -> Optional[Balance]:
+        return self._latest.get(file_name, {}).get(account)
+
+
+class LedgerSnapshot:
+    """
+    The result of a single parse of the main ledger (and everything it includes).
+    Treat this as read-only, it is shared between requests.
+    """
+
+    main_ledger: str
+    entries: Entries
+    errors: List[Any]
+    options_map: Dict[str, Any]
+    stamps: Dict[str, FileStamp]  # { included filename => stamp }
+    balances: BalanceIndex
+    renderer: EntryRenderer  # with the ledger's own precision
+    _duplicates: Dict[Tuple[int, Decimal], DuplicateIndex]
+    _duplicates_lock: Lock
+
+    def __init__(
+        self,
+        main_ledger: str,
+        entries: Entries,
+        errors: List[Any],
+        options_map: Dict[str, Any],
+        stamps: Dict[str, FileStamp],
+    ) -> None:
+        self.main_ledger = main_ledger
+        self.entries = entries
+        self.errors = errors
+        self.options_map = options_map
+        self.stamps = stamps
+        self.balances = BalanceIndex(entries)
+        self.renderer = EntryRenderer(ledger_display_context(options_map))
+        self._duplicates = {}
+        self._duplicates_lock = Lock()
+
+    def duplicates(self, window_days: int, tolerance: Decimal) -> DuplicateIndex:
+        """
+        Built on first use, since only collect runs need it
+        """
+        with self._duplicates_lock:
+            key = (window_days, tolerance)
+            if key not in self._duplicates:
+                self._duplicates[key] = DuplicateIndex(
+                    self.entries, window_days, tolerance
+                )
+            return self._duplicates[key]
+
+    def is_fresh(self) -> bool:
+        """
+        Cheap check first (mtime and size), and only hash the file if those changed.
+        That way a `touch` or an identical rewrite doesn't cause a re-parse.
+        """
+        for fname, stamp in list(self.stamps.items()):
+            try:
+                st = os.stat(fname)
+            except FileNotFoundError:
+                return False
+            if st.st_mtime_ns == stamp.mtime_ns and st.st_size == stamp.size:
+                continue
+            if st.st_size != stamp.size or file_digest(fname) != stamp.digest:
+                return False
+            # Same contents, so just remember the new mtime
+            self.stamps[fname] = FileStamp(
+                mtime_ns=st.st_mtime_ns, size=st.st_size, digest=stamp.digest
+            )
+        return True
+
+    def parsed_as_is(self, fname: str) -> bool:
+        """
+        Whether $fname is still what was parsed, so that the line numbers of its entries
+        are right. Files that aren't part of the ledger have no entries to be wrong about.
+        """
+        stamp = self.stamps.get(fname)
+        if stamp is None:
+            return True
+        try:
+            return file_digest(fname) == stamp.digest
+        except FileNotFoundError:
+            return False
+
+
+class LedgerCache:
+    """
+    Long-lived holder of the parsed main ledger, shared by the collect, sort and config apps.
+    The ledger is only re-parsed when one of the included .beancount files changes on disk.
+    """
+
+    _config: Any
+    _snapshot: Optional[LedgerSnapshot]
+    _lock: Lock
+
+    def __init__(self, config: Any) -> None:
+        self._config = config
+        self._snapshot = None
+        self._lock = Lock()
+
+    def main_ledger(self) -> str:
+        return str(Path("/data") / self._config["files"]["main-ledger"])
+
+    def snapshot(self) -> LedgerSnapshot:
+        with self._lock:
+            main_ledger = self.main_ledger()
+            snap = self._snapshot
+            if snap is None or snap.main_ledger != main_ledger or not snap.is_fresh():
+                snap = self._load(main_ledger)
+                self._snapshot = snap
+            return snap
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def _load(self, main_ledger: str) -> LedgerSnapshot:
+        """
+        Files can be written while they're being parsed (not everyone holds the writer's
+        lock), so they're stamped before the parse as well as after. The ones that changed
+        in between get a stamp that makes the next snapshot() parse them again.
+        """
+        known = {main_ledger}
+        if self._snapshot is not None and self._snapshot.main_ledger == main_ledger:
+            known.update(self._snapshot.stamps)
+        started_ns = time.time_ns()
+        before = {fname: _try_stamp(fname) for fname in known}
+        logging.info("Parsing %s", main_ledger)
+        entries, errors, options_map = loader.load_file(main_ledger)
+        stamps = {}
+        for fname in options_map["include"]:
+            stamp = _stamp(fname)
+            if fname in before:
+                changed = before[fname] != stamp
+            else:
+                # Only found by this parse, so could have been written during it
+                changed = stamp.mtime_ns >= started_ns - MTIME_SLACK_NS
+            stamps[fname] = STALE if changed else stamp
+        return LedgerSnapshot(main_ledger, entries, errors, options_map, stamps)
@@ -0,0 +1,181 @@
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+import fcntl
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from .alignment import Edit, align_edits, edits_overlap, file_widths, remember_widths
+from .utilities import write_atomically
+
+# Given the current lines of the file, the edits to make to them, and what to hand back
+# to whoever submitted it. Called with the file locked.
+EditBatch = Callable[[List[str]], Tuple[List[Edit], Any]]
+
+
+@dataclass(frozen=True)
+class Written:
+    before: str  # contents of the file before the write
+    after: str  # and after, including any other batches that were written with this one
+    value: Any  # what the batch returned
+
+
+class _FileQueue:
+    write_lock: Lock
+    pending: List[Tuple[EditBatch, "Future[Written]"]]
+    pending_lock: Lock
+
+    def __init__(self) -> None:
+        self.write_lock = Lock()
+        self.pending = []
+        self.pending_lock = Lock()
+
+
+class LedgerWriter:
+    """
+    All the writes to the ledger files go through here, so that collect runs and sort
+    commits never race. Each file has a lock, held across worker processes as well (a
+    flock on a file next to it), and a queue of edit batches.
+    Only the merge and write are serialized: the batches are cheap, they only work out
+    where their (already fetched and formatted) entries go in the current lines. Batches
+    that queue up while a write is in progress are written together, with a single align
+    and write, as long as their edits don't overlap.
+    """
+
+    _files: Dict[Path, _FileQueue]
+    _files_lock: Lock
+
+    def __init__(self) -> None:
+        self._files = {}
+        self._files_lock = Lock()
+
+    def submit(self, path: Path, batch: EditBatch) -> Written:
+        """
+        Blocks until $batch is written out to $path. Raises whatever $batch raised.
+        """
+        queue = self._queue(path)
+        future: "Future[Written]" = Future()
+        with queue.pending_lock:
+            queue.pending.append((batch, future))
+        with self.locked(path):
+            # Whoever holds the lock writes out everything pending, including ours
+            if not future.done():
+                self._write_pending(path, queue)
+        return future.result()
+
+    def write_together(
+        self, batches: Dict[Path, EditBatch]
+    ) -> Dict[Path, "Future[Written]"]:
+        """
+        Writes out $batches with all of their files locked. Every batch is run before any
+        file is written, so if one raises, nothing is written and that is raised.
+        The files are still written one after the other, and the (done) futures say which
+        of them were.
+        """
+        with self.locked(*batches):
+            prepared = []
+            for path, batch in batches.items():
+                with open(path, "r") as f:
+                    before = f.read()
+                lines = before.splitlines()
+                edits, value = batch(lines)
+                prepared.append((path, before, lines, edits, value))
+            futures: Dict[Path, "Future[Written]"] = {}
+            for path, before, lines, edits, value in prepared:
+                future: "Future[Written]" = Future()
+                try:
+                    after = self._write_edits(path, before, lines, edits)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(Written(before=before, after=after, value=value))
+                futures[path] = future
+            return futures
+
+    @contextmanager
+    def locked(self, *paths: Path) -> Iterator[None]:
+        """
+        Holds the locks of $paths, so that none of them is written in the meantime
+        """
+        with ExitStack() as stack:
+            # Always in the same order, so that two of these can't deadlock
+            for path in sorted(set(paths)):
+                stack.enter_context(self._queue(path).write_lock)
+                lock_file = stack.enter_context(
+                    open(path.with_name(f".{path.name}.lock"), "a")
+                )
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _queue(self, path: Path) -> _FileQueue:
+        with self._files_lock:
+            if path not in self._files:
+                self._files[path] = _FileQueue()
+            return self._files[path]
+
+    def _write_pending(self, path: Path, queue: _FileQueue):
+        with queue.pending_lock:
+            batch, queue.pending = queue.pending, []
+        try:
+            while batch:
+                try:
+                    batch = self._write_round(path, batch)
+                except Exception as e:
+                    # Everyone waiting on this round gets the error, not just us
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    batch = []
+        finally:
+            # Whatever happened, nobody is left blocked on their future
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"{path} was not written"))
+
+    def _write_round(
+        self, path: Path, batch: List[Tuple[EditBatch, "Future[Written]"]]
+    ) -> List[Tuple[EditBatch, "Future[Written]"]]:
+        """
+        Writes out the batches that don't overlap, in one go.
+        Returns the ones that have to wait for the next round.
+        """
+        with open(path, "r") as f:
+            before = f.read()
+        lines = before.splitlines()
+        edits: List[Edit] = []
+        taken, rest = [], []
+        for edit_batch, future in batch:
+            try:
+                new_edits, value = edit_batch(lines)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if any(edits_overlap(a, b) for a in new_edits for b in edits):
+                # Against the lines that the others have written, next time around
+                rest.append((edit_batch, future))
+            else:
+                edits.extend(new_edits)
+                taken.append((future, value))
+        try:
+            after = self._write_edits(path, before, lines, edits)
+        except Exception as e:
+            for future, _ in taken:
+                future.set_exception(e)
+            taken = []
+        for future, value in taken:
+            future.set_result(Written(before=before, after=after, value=value))
+        return rest
+
+    def _write_edits(
+        self, path: Path, before: str, lines: List[str], edits: List[Edit]
+    ) -> str:
+        """
+        Aligns and writes $edits to $path, which must be locked. Returns the new contents.
+        """
+        if not edits:
+            return before
+        after, widths = align_edits(lines, edits, file_widths(path, lines))
+        write_atomically(path, after)
+        remember_widths(path, widths)
+        return after
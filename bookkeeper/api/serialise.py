@@ -1,12 +1,16 @@
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Set
+from decimal import Decimal
+from json.encoder import INFINITY, encode_basestring_ascii
+from typing import Any, Callable, Dict, List, Optional, Set
 
 from beancount.core.data import (
     Directive,
     Posting,
     Amount,
+    Transaction,
 )
 from beancount.core.number import D
+from flask.json.provider import DefaultJSONProvider
 
 
 class DirectiveForSort:
@@ -66,6 +70,183 @@ def to_dict(item: Any) -> Dict:
         raise RuntimeError("Unexpected type passed to_dict(): {}".format(type(item)))
 
 
+def to_json(item: Any) -> str:
+    """
+    Same as json.dumps(to_dict($item)), with Decimals as strings, but written straight out
+    without building all the dicts in between. Anything else is encoded the way Flask does.
+    """
+    out: List[str] = []
+    _write(item, out)
+    return "".join(out)
+
+
+class DirectJSONProvider(DefaultJSONProvider):
+    """
+    Encodes responses with to_json(), so that endpoints can return the beancount entries
+    (and DirectiveForSort, DirectiveMod) as they are.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return to_json(obj)
+
+
+def _write(item: Any, out: List[str]):
+    writer = _WRITERS.get(type(item))
+    if writer is not None:
+        writer(item, out)
+    elif isinstance(item, DirectiveForSort):
+        _write_drs(item, out)
+    elif isinstance(item, Directive):
+        _write_directive(item, out)
+    elif isinstance(item, DirectiveMod):
+        _write_mod(item, out)
+    elif isinstance(item, dict):
+        _write_dict(item, out)
+    elif isinstance(item, (list, tuple)):
+        _write_list(item, out)
+    elif isinstance(item, str):
+        out.append(encode_basestring_ascii(item))
+    else:
+        _write(DefaultJSONProvider.default(item), out)
+
+
+def _write_str(item: str, out: List[str]):
+    out.append(encode_basestring_ascii(item))
+
+
+def _write_optional_str(item: Optional[str], out: List[str]):
+    out.append("null" if item is None else encode_basestring_ascii(item))
+
+
+def _write_list(items: Any, out: List[str]):
+    out.append("[")
+    first = True
+    for item in items:
+        if not first:
+            out.append(",")
+        first = False
+        _write(item, out)
+    out.append("]")
+
+
+def _write_dict(item: Dict, out: List[str]):
+    out.append("{")
+    first = True
+    for key, value in item.items():
+        if not first:
+            out.append(",")
+        first = False
+        if type(key) is not str:
+            # Same as json.dumps()
+            key = _KEYS[key] if key is None or type(key) is bool else str(key)
+        out.append(encode_basestring_ascii(key))
+        out.append(":")
+        _write(value, out)
+    out.append("}")
+
+
+def _write_drs(item: "DirectiveForSort", out: List[str]):
+    out.append('{"id":')
+    out.append(encode_basestring_ascii(item.id))
+    out.append(',"auto_category":')
+    _write_optional_str(item.auto_category, out)
+    out.append(',"entry":')
+    _write_directive(item.entry, out)
+    out.append("}")
+
+
+def _write_directive(item: Directive, out: List[str]):
+    out.append('{"date":"')
+    out.append(item.date.isoformat())
+    out.append('","filename":')
+    out.append(encode_basestring_ascii(item.meta["filename"]))
+    out.append(',"lineno":')
+    out.append(str(item.meta["lineno"]))
+    out.append(',"payee":')
+    _write_optional_str(item.payee, out)
+    out.append(',"narration":')
+    _write_optional_str(item.narration, out)
+    out.append(',"postings":')
+    _write_postings(item.postings, out)
+    out.append(',"flag":')
+    _write_optional_str(item.flag, out)
+    out.append(',"tags":')
+    _write_list(item.tags, out)
+    out.append(',"links":')
+    _write_list(item.links, out)
+    out.append("}")
+
+
+def _write_postings(postings: Any, out: List[str]):
+    out.append("[")
+    first = True
+    for posting in postings:
+        if not first:
+            out.append(",")
+        first = False
+        out.append('{"account":')
+        out.append(encode_basestring_ascii(posting.account))
+        out.append(',"units":')
+        _write(posting.units, out)
+        out.append("}")
+    out.append("]")
+
+
+def _write_amount(item: Amount, out: List[str]):
+    out.append('{"number":')
+    _write(item.number, out)
+    out.append(',"currency":')
+    _write(item.currency, out)
+    out.append("}")
+
+
+def _write_mod(item: "DirectiveMod", out: List[str]):
+    out.append('{"id":')
+    out.append(encode_basestring_ascii(item.id))
+    out.append(',"type":')
+    out.append(encode_basestring_ascii(item.type))
+    out.append(',"postings":')
+    if item.postings:
+        _write_postings(item.postings, out)
+    else:
+        out.append("null")
+    out.append(',"payee":')
+    _write_optional_str(item.payee, out)
+    out.append(',"narration":')
+    _write_optional_str(item.narration, out)
+    out.append("}")
+
+
+def _write_float(item: float, out: List[str]):
+    # Same as json.dumps(), which writes NaN and Infinity where repr() has nan and inf
+    if item != item:
+        out.append("NaN")
+    elif item == INFINITY:
+        out.append("Infinity")
+    elif item == -INFINITY:
+        out.append("-Infinity")
+    else:
+        out.append(float.__repr__(item))
+
+
+_KEYS = {None: "null", True: "true", False: "false"}
+
+# By exact type, the common cases don't need to go through the isinstance() checks
+_WRITERS: Dict[type, Callable[[Any, List[str]], None]] = {
+    str: _write_str,
+    int: lambda item, out: out.append(int.__repr__(item)),
+    float: _write_float,
+    bool: lambda item, out: out.append("true" if item else "false"),
+    type(None): lambda item, out: out.append("null"),
+    Decimal: lambda item, out: out.append(encode_basestring_ascii(str(item))),
+    list: _write_list,
+    tuple: _write_list,
+    dict: _write_dict,
+    Transaction: _write_directive,
+    Amount: _write_amount,
+}
+
+
 @dataclass
 class DirectiveMod:
     id: str
@@ -102,7 +283,7 @@ def mod_from_dict(item: Any) -> DirectiveMod:
         id=item["id"],
         type=item["type"],
         postings={_posting_from_dict(p) for p in item["postings"]}
-        if "postings" in item
+        if item.get("postings") is not None
         else None,
         payee=item["payee"] if "payee" in item else None,
         narration=item["narration"] if "narration" in item else None,
@@ -110,6 +291,10 @@ def mod_from_dict(item: Any) -> DirectiveMod:
     return mod
 
 
+_WRITERS[DirectiveForSort] = _write_drs
+_WRITERS[DirectiveMod] = _write_mod
+
+
 @dataclass(frozen=True)
 class Account:
     name: str
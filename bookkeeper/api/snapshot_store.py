@@ -0,0 +1,224 @@
+from datetime import datetime
+from fnmatch import fnmatch
+from hashlib import sha256
+import json
+import os
+from pathlib import Path
+from threading import Lock
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import zlib
+
+from .utilities import write_atomically
+
+# Not worth keeping: the git repo has its own history, the rest is rebuilt or transient
+BACKUP_EXCLUDE = [
+    ".git",
+    "*.picklecache",
+    # lock files and the temp files of write_atomically()
+    ".*.beancount.*",
+    ".sort-session.log*",
+]
+# Chunks end after a line whose crc32 has these bits clear, so ~1 in 256 lines
+CHUNK_MASK = 0xFF
+MIN_CHUNK = 1024
+MAX_CHUNK = 64 * 1024
+
+# { relative path => { size, mtime_ns, mode, digest, chunks } }
+Files = Dict[str, Dict[str, Any]]
+# { id, created, files }
+Manifest = Dict[str, Any]
+
+
+class SnapshotStore:
+    """
+    Backups of $source, as snapshots in $root that share their (compressed) chunks.
+    Files are split into chunks on line boundaries picked by the lines' contents, so an
+    edit only changes the chunk it's in, and each chunk is stored once, by its hash.
+    A snapshot is just a manifest of the chunks that make up each file.
+
+    root/objects/ab/cdef... -- zlib compressed chunk, named after the sha256 of its contents
+    root/snapshots/<id>.json -- manifest, the ids sort oldest to newest
+    """
+
+    root: Path
+    source: Path
+    _lock: Lock
+
+    def __init__(self, root: Path, source: Path) -> None:
+        self.root = root
+        self.source = source
+        self._lock = Lock()
+
+    def snapshots(self) -> List[str]:
+        """
+        Ids of all the snapshots, oldest first
+        """
+        return sorted(p.stem for p in (self.root / "snapshots").glob("*.json"))
+
+    def manifest(self, id: str) -> Manifest:
+        with open(self.root / "snapshots" / f"{id}.json", "r") as f:
+            return json.load(f)
+
+    def latest(self) -> Optional[Manifest]:
+        ids = self.snapshots()
+        return self.manifest(ids[-1]) if ids else None
+
+    def backup(self) -> Tuple[Manifest, bool]:
+        """
+        Snapshot $source as it is now. The files that haven't been touched since the last
+        snapshot (same size and mtime) aren't even read.
+        Returns the snapshot, and whether it's a new one: if nothing changed, it's the
+        latest one instead.
+        """
+        with self._lock:
+            latest = self.latest()
+            previous: Files = latest["files"] if latest else {}
+            files: Files = {}
+            for rel, st in self._walk():
+                prev = previous.get(rel)
+                if _unchanged(prev, st):
+                    files[rel] = prev
+                    continue
+                data = (self.source / rel).read_bytes()
+                digest = sha256(data).hexdigest()
+                if prev is not None and prev["digest"] == digest:
+                    chunks = prev["chunks"]
+                else:
+                    chunks = [self._put(chunk) for chunk in _chunks(data)]
+                files[rel] = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "mode": st.st_mode,
+                    "digest": digest,
+                    "chunks": chunks,
+                }
+            if latest is not None and files == previous:
+                return latest, False
+            contents = json.dumps(files, sort_keys=True)
+            id = "{}-{}".format(
+                datetime.now().strftime("%Y%m%dT%H%M%S.%f"),
+                sha256(contents.encode()).hexdigest()[:8],
+            )
+            manifest = {"id": id, "created": time.time(), "files": files}
+            (self.root / "snapshots").mkdir(parents=True, exist_ok=True)
+            write_atomically(
+                self.root / "snapshots" / f"{id}.json", json.dumps(manifest)
+            )
+            return manifest, True
+
+    def changes(self, manifest: Manifest) -> Dict[str, str]:
+        """
+        What's different in $source since $manifest was taken.
+        Returns { relative path => "added" | "removed" | "modified" }
+        """
+        files: Files = manifest["files"]
+        changed = {}
+        seen = set()
+        for rel, st in self._walk():
+            seen.add(rel)
+            prev = files.get(rel)
+            if prev is None:
+                changed[rel] = "added"
+            elif not _unchanged(prev, st):
+                # Could have just been touched
+                data = (self.source / rel).read_bytes()
+                if sha256(data).hexdigest() != prev["digest"]:
+                    changed[rel] = "modified"
+        for rel in files.keys() - seen:
+            changed[rel] = "removed"
+        return changed
+
+    def read(self, manifest: Manifest, rel: str) -> Optional[bytes]:
+        """
+        Contents of $rel in the snapshot, None if it wasn't there
+        """
+        entry = manifest["files"].get(rel)
+        if entry is None:
+            return None
+        return b"".join(self._get(chunk) for chunk in entry["chunks"])
+
+    def restore(self, id: str) -> Tuple[str, List[str]]:
+        """
+        Puts the files of snapshot $id back in $source, after taking a snapshot of how
+        things are now (so this can be undone). Files that weren't in the snapshot are
+        left alone.
+        Returns the id of the snapshot to undo with, and the files that were restored
+        """
+        manifest = self.manifest(id)
+        undo, _ = self.backup()
+        restored = []
+        for rel, entry in sorted(manifest["files"].items()):
+            path = self.source / rel
+            try:
+                if sha256(path.read_bytes()).hexdigest() == entry["digest"]:
+                    continue
+            except FileNotFoundError:
+                path.parent.mkdir(parents=True, exist_ok=True)
+            data = self.read(manifest, rel)
+            assert data is not None
+            write_atomically(path, data)
+            os.chmod(path, entry["mode"])
+            restored.append(rel)
+        return undo["id"], restored
+
+    def _walk(self) -> Iterator[Tuple[str, os.stat_result]]:
+        for dirpath, dirnames, filenames in os.walk(self.source):
+            dirnames[:] = [d for d in dirnames if not _excluded(d)]
+            for name in filenames:
+                if _excluded(name):
+                    continue
+                path = Path(dirpath) / name
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    # Gone in the meantime
+                    continue
+                yield path.relative_to(self.source).as_posix(), st
+
+    def _object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / digest[2:]
+
+    def _put(self, chunk: bytes) -> str:
+        digest = sha256(chunk).hexdigest()
+        path = self._object_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_atomically(path, zlib.compress(chunk))
+        return digest
+
+    def _get(self, digest: str) -> bytes:
+        return zlib.decompress(self._object_path(digest).read_bytes())
+
+
+def _excluded(name: str) -> bool:
+    return any(fnmatch(name, pattern) for pattern in BACKUP_EXCLUDE)
+
+
+def _unchanged(prev: Optional[Dict[str, Any]], st: os.stat_result) -> bool:
+    return (
+        prev is not None
+        and prev["size"] == st.st_size
+        and prev["mtime_ns"] == st.st_mtime_ns
+    )
+
+
+def _chunks(data: bytes) -> Iterator[bytes]:
+    """
+    Cuts $data after the lines whose hash hits CHUNK_MASK, so the cuts move along with
+    the lines when lines are added or removed before them
+    """
+    start = pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos, pos + MAX_CHUNK)
+        end = min(len(data), pos + MAX_CHUNK) if end == -1 else end + 1
+        line = data[pos:end]
+        pos = end
+        size = pos - start
+        if size >= MAX_CHUNK or (
+            size >= MIN_CHUNK and zlib.crc32(line) & CHUNK_MASK == 0
+        ):
+            yield data[start:pos]
+            start = pos
+    if start < len(data):
+        yield data[start:]
@@ -1,14 +1,10 @@
+from datetime import date, timedelta
+import logging
 from itertools import chain, groupby
-from shutil import copy
-from tempfile import TemporaryDirectory
-import textwrap
-from typing import Set, List
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from pathlib import Path
-from hashlib import sha1
-from copy import deepcopy
 
-from flask import Flask, request
-from beancount import loader
+from flask import Flask, jsonify, request
 from beancount.core.data import (
     Entries,
     Transaction,
@@ -19,25 +15,104 @@ from beancount.core.data import (
     Close,
 )
 from beancount.core.number import D
-from beancount.scripts.format import align_beancount
-from beancount.ops import validation
-from beancount.parser import printer
 
+from .alignment import Edit, EditConflict, align_edits, file_widths, rebase_edits
 from .config_app import Config
+from .ledger_cache import LedgerCache
+from .ledger_writer import EditBatch, LedgerWriter
 from .serialise import DirectiveForSort
-from .sort_cache import Cache
-from .formatting import DISPLAY_CONTEXT, indentation_at
-from .serialise import DirectiveForSort, DirectiveMod, mod_from_dict, to_dict
-from .utilities import TODO_ACCOUNT, parse_journal
+from .sort_cache import Cache, EntryQueue
+from .sort_categories import PayeeHistory
+from .sort_check import LedgerChecker
+from .sort_link import (
+    DEFAULT_TOLERANCE,
+    LEDGER_LINK_DAYS,
+    AmountIndex,
+    entry_postings,
+    ledger_index,
+)
+from .sort_session import SESSION_LOG, EntryKeys, SessionLog, entry_key
+from .formatting import DEFAULT_RENDERER, EntryRenderer, indentation_at
+from .serialise import DirectiveForSort, DirectiveMod, mod_from_dict
+from .utilities import (
+    DEFAULT_DIFF_CONTEXT,
+    TODO_ACCOUNT,
+    content_hash,
+    text_diff,
+)
 
 SUPPORTED_DIRECTIVES = {Transaction}
 TAG_SKIP_SORT = "skip-sort"
-DELETED_LINE = "\0"
 DEFAULT_MAX_TXNS = 20
+# Keeps each response a bounded size, however many TODOs there are
+MAX_TXNS_LIMIT = 200
 
 
-def create_sort_app(app: Flask, config: Config):
+def create_sort_app(
+    app: Flask, config: Config, ledger: LedgerCache, writer: LedgerWriter
+):
     cache = Cache()
+    # Outlives the sorting sessions, so it's only built from the ledger once
+    history = PayeeHistory()
+    checker = LedgerChecker()
+
+    def load_entries(
+        cache: Cache, logged: Optional[Tuple[EntryKeys, EntryKeys]] = None
+    ):
+        """
+        Parses the destination files, and fills in the entries to sort, ranked. With the
+        $logged (unsorted, sorted) entries of a session, it's just those, as they were.
+        """
+        assert cache.destination_files is not None
+        # Load the journal files, all in the one parse
+        paths = [Path("/data") / name for name in cache.destination_files]
+        # So that nothing is written to them in between the parse and the read
+        with writer.locked(*paths):
+            snapshot = ledger.snapshot()
+            for path in paths:
+                if path.exists():
+                    cache.sources[path.name] = path.read_text()
+        all_entries = snapshot.entries
+        cache.renderer = snapshot.renderer
+        cache.accounts = sorted(_open_accounts(all_entries))
+        to_sort = [entry for entry in all_entries if _is_sortable(cache, entry)]
+        if not history.loaded:
+            history.load(all_entries)
+        if logged is None:
+            # Rank todos by most promising
+            categorised = [
+                _auto_categorise(config, history, str(i), entry)
+                for (i, entry) in enumerate(to_sort)
+            ]
+            cache.unsorted = EntryQueue(_rank_order(categorised))
+            cache.total = len(cache.unsorted)
+        else:
+            by_key: Dict[str, List[Directive]] = {}
+            for entry in to_sort:
+                by_key.setdefault(entry_key(entry), []).append(entry)
+
+            def find(keys: EntryKeys) -> Iterator[DirectiveForSort]:
+                for id, key in keys:
+                    if by_key.get(key):
+                        entry = by_key[key].pop(0)
+                        yield _auto_categorise(config, history, id, entry)
+
+            unsorted_keys, sorted_keys = logged
+            cache.unsorted = EntryQueue(find(unsorted_keys))
+            cache.sorted = EntryQueue(find(sorted_keys))
+        # For /sort/link
+        cache.links = AmountIndex(
+            (number, when, drs.id)
+            for drs in cache.unsorted
+            for number, when in entry_postings(drs.entry)
+        )
+        oldest = min((e.date for e in to_sort), default=date.today())
+        cache.ledger_links = ledger_index(
+            all_entries, oldest - timedelta(days=LEDGER_LINK_DAYS)
+        )
+
+    # Picks up where the last process left off
+    session = SessionLog(Path("/data") / SESSION_LOG, load_entries)
 
     @app.route("/sort/progress", methods=["GET", "POST"])
     def sort_progress():
@@ -46,20 +121,25 @@ def create_sort_app(app: Flask, config: Config):
         Call this to init the UI. Gives the various files and accounts info needed.
 
         POST
-        Called when setting the current sorting options. When the destination file and options are chosen.
-        Body (form): destination_file, main_file -- both are just the file name
+        Called when setting the current sorting options. When the destination files and options are chosen.
+        Body (form): destination_files -- any number of file names, all of the journal files if none
         """
+        session.sync(cache)
+        journal_files = sorted(p.name for p in Path("/data").glob("*.beancount"))
         if request.method == "POST":
             if len(cache.sorted) > 0:
                 raise UserWarning("You have unsaved sortings that will be lost")
             cache.reset()
             cache.op = "sort"
-            cache.destination_file = request.form.get("destination_file")
+            cache.destination_files = (
+                request.form.getlist("destination_files") or journal_files
+            )
+            session.save(cache)
             config.reload()
         return {
-            "destination_file": cache.destination_file,
+            "destination_files": cache.destination_files,
             "main_file": config["files"]["main-ledger"],
-            "journal_files": [p.name for p in Path("/data").glob("*.beancount")],
+            "journal_files": journal_files,
         }
 
     @app.route("/sort/next", methods=["GET", "POST"])
@@ -67,10 +147,14 @@ def create_sort_app(app: Flask, config: Config):
         """
         GET
         Called to get the first page of entries to sort.
-        Args: max -- int for how many entries to return
+        Args: max -- int for how many entries to return, cursor -- from the last response
+        Only the entries that haven't been sent for this cursor yet are returned. Without a
+        cursor (or with a stale one), a new cursor is returned, and the client starts over.
+        The accounts are at /sort/accounts.
 
         POST
         Called when submitting categorisations that have been made, along with returning the next page of entries.
+        Args: same as GET
         Body (JSON): "sorted"
         Re: "sorted" -- See DirectiveMod. DirectiveMod is a JSON object which includes only the _new_ postings that will replace the equity:todo posting.
         {
@@ -90,127 +174,150 @@ def create_sort_app(app: Flask, config: Config):
         It can have type "skip" or "delete" too, which are hopefully self-explanatory. No new postings included then.
         Re: "skip", it is a transaction that I don't want to handle right away. We'll set #skip-sort on them.
         """
+        session.sync(cache)
         if request.method == "POST":
             # store the submitted categorisations. insert in the right place to in-memory store
             assert request.json is not None and cache.unsorted is not None
             mods = [mod_from_dict(dct) for dct in request.json["sorted"]]
             for mod in mods:
-                mod_idx = _index_of(cache.unsorted, mod.id)
                 # remove sorted item from to_sort and put it in sorted
-                cache.sorted.append(cache.unsorted[mod_idx])
+                drs = cache.unsorted.pop(mod.id)
+                cache.sorted.append(drs)
                 cache.mods[mod.id] = mod
-                del cache.unsorted[mod_idx]
+                cache.edits.pop(_file_name(drs), None)
+            session.sorted(cache, mods)
         if cache.unsorted is None:
             assert cache.accounts is None
-            assert cache.destination_file is not None
-            # Load the journal file
-            all_entries = parse_journal(
-                str(Path("/data") / config["files"]["main-ledger"])
-            )
-            cache.accounts = sorted(_open_accounts(all_entries))
-            to_sort = [entry for entry in all_entries if _is_sortable(cache, entry)]
-            # Rank todos by most promising
-            categorised = [
-                _auto_categorise(config, str(i), entry)
-                for (i, entry) in enumerate(to_sort)
-            ]
-            cache.unsorted = _rank_order(categorised)
-            cache.total = len(cache.unsorted)
+            load_entries(cache)
+            session.save(cache)
         assert cache.total is not None
-        # find the $max most promising and return that here
-        max_txns = request.args.get("max", DEFAULT_MAX_TXNS)
+        # find the $max most promising, that this client doesn't have yet
+        cursor, delivered = cache.cursors.get(request.args.get("cursor"))
+        page = cache.unsorted.head(_max_txns(), skip=delivered)
+        cache.cursors.mark(cursor, (drs.id for drs in page))
         return {
-            "to_sort": [to_dict(txn) for txn in cache.unsorted[:max_txns]],
-            "accounts": cache.accounts,
+            "cursor": cursor,
+            "to_sort": page,
             "count_total": cache.total,
             "count_sorted": cache.total - len(cache.unsorted),
         }
 
+    @app.route("/sort/accounts")
+    def accounts_sort():
+        """
+        The open accounts, for auto-complete. Changes rarely, so it has an ETag, and the
+        client gets a 304 when it already has the latest.
+        """
+        session.sync(cache)
+        accounts = cache.accounts
+        if accounts is None:
+            accounts = sorted(_open_accounts(ledger.snapshot().entries))
+        response = jsonify(accounts=accounts)
+        response.set_etag(content_hash("\n".join(accounts)), weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
+
     @app.route("/sort/commit", methods=["GET", "POST"])
     def commit_sort():
         """
         POST
-        Args: write=True for this to actually write out to the file
+        Args: write=True for this to actually write out to the files
+        Only the files with mods are touched, and they are written out together.
+        Returns a unified diff of those files, and hashes of their contents before and after.
+        Optional args: context -- lines around each change, full=True to also get the full
+        contents.
+        Anything written to the files since the session started (eg. by a collect run) is
+        kept, the mods are moved to where their lines are now. If those lines were changed,
+        this is a 409.
         """
-        assert cache.destination_file is not None
-        with open(Path("/data") / cache.destination_file) as dest:
-            before = dest.read()
-        dest_output = _create_output(cache)
-        # Run the beancount auto-formatter
-        formatted_output = align_beancount(dest_output)
+        session.sync(cache)
+        assert cache.destination_files is not None
         written = False
-        if request.args.get("write", False):
-            assert request.method == "POST"
-            with open(Path("/data") / cache.destination_file, mode="w") as dest:
-                dest.write(formatted_output)
+        try:
+            if request.args.get("write", False):
+                assert request.method == "POST"
+                outputs = _write_outputs(cache, history, session, writer)
                 written = True
                 cache.reset()
-            # assuming this is written successfully
-            before = formatted_output
-        return {"before": before, "after": formatted_output, "written": written}
+                session.clear()
+                outputs = {name: (after, after) for name, (_, after) in outputs.items()}
+            else:
+                outputs = _formatted_outputs(cache)
+        except EditConflict as e:
+            return {"error": str(e)}, 409
+        context = request.args.get("context", DEFAULT_DIFF_CONTEXT, type=int)
+        response = {
+            "diff": "".join(
+                text_diff(before, after, name, context)
+                for name, (before, after) in outputs.items()
+            ),
+            "hashes": {
+                name: {"before": content_hash(before), "after": content_hash(after)}
+                for name, (before, after) in outputs.items()
+            },
+            "written": written,
+        }
+        if request.args.get("full", False):
+            response["contents"] = {
+                name: {"before": before, "after": after}
+                for name, (before, after) in outputs.items()
+            }
+        return response
 
     @app.route("/sort/check", methods=["POST"])
     def check_sort():
         """
         Check that bean-check passes on the new file contents.
-        It does this by copying the .beancount files to a new temp folder,
-        writing out the new contents, and then running bean-check.
-        Since that is a write operation (though it doesn't touch the original
-        files), this needs to be a POST.
+        The new contents are checked in memory, in a worker process, so the files on disk
+        aren't touched. A newer check cancels this one, and then "cancelled" is set.
+        This is still a POST, since it kicks off the work.
         """
-        assert cache.destination_file is not None
-        dest_output = _create_output(cache)
-        formatted_output = align_beancount(dest_output)
-
-        with TemporaryDirectory() as scratch:
-            # copy all the .beancount files to the temp directory
-            for f in Path("/data").glob("*.beancount"):
-                copy(Path("/data") / f, scratch)
-            # override the contents of "dest" with new content
-            with open(Path(scratch) / cache.destination_file, "w") as dest:
-                dest.write(formatted_output)
-            _, errors, _ = loader.load_file(
-                Path(scratch) / config["files"]["main-ledger"],
-                # Force slow and hardcore validations.
-                extra_validations=validation.HARDCORE_VALIDATIONS,
-            )
-
-        def hash_error(error):
-            h = sha1(error.source["filename"].encode())
-            h.update(str(error.source["lineno"]).encode())
-            h.update(error.message.encode())
-            return h.hexdigest()
-
-        return {
-            "check": not errors,
-            "errors": {
-                hash_error(error): printer.format_error(error) for error in errors
-            },
-        }
+        session.sync(cache)
+        assert cache.destination_files is not None
+        # All the edited files together, since they're all part of the one ledger
+        try:
+            outputs = _formatted_outputs(cache)
+        except EditConflict as e:
+            return {"error": str(e)}, 409
+        errors = checker.check(
+            Path("/data") / config["files"]["main-ledger"],
+            {Path("/data") / name: after for name, (_, after) in outputs.items()},
+        )
+        if errors is None:
+            return {"check": False, "cancelled": True, "errors": {}}
+        return {"check": not errors, "errors": errors}
 
     @app.route("/sort/link")
     def link_sort():
         """
-        Searches for a linked Transaction
+        Searches for a linked Transaction, by amount.
+        Args: txnID, amount, and optionally tolerance, days -- how far apart the dates can be,
+        and cursor -- so that /sort/next doesn't send the "results" again
+        Returns the matches that are still to sort in "results", and the ones that are already
+        categorised in the ledger in "ledger". Both with the closest dates first.
         """
+        session.sync(cache)
         assert cache.unsorted is not None
-        txn_id = request.args.get("txnID")
+        assert cache.links is not None and cache.ledger_links is not None
+        txn_id = request.args.get("txnID", "")
         amount = D(request.args.get("amount"))
         assert amount is not None
-        amount_abs = amount.copy_abs()
+        tolerance = D(request.args.get("tolerance", DEFAULT_TOLERANCE))
+        days = request.args.get("days", type=int)
+        around = None
+        for items in (cache.sorted, cache.unsorted):
+            if txn_id in items:
+                around = items[txn_id].entry.date
         matching = [
-            txn
-            for txn in cache.unsorted
-            if txn_id != txn.id
-            and any(
-                [
-                    (p.units.number.copy_abs() - amount_abs).copy_abs() < 0.01
-                    for p in txn.entry.postings
-                ]
-            )
+            cache.unsorted[id]
+            for id in cache.links.near(amount, tolerance, around, days)
+            if id != txn_id and id in cache.unsorted
         ]
+        in_ledger = cache.ledger_links.near(amount, tolerance, around, days)
+        cache.cursors.mark(request.args.get("cursor"), (drs.id for drs in matching))
         return {
-            "results": [to_dict(txn) for txn in matching],
+            "results": matching,
+            "ledger": in_ledger,
         }
 
     @app.route("/sort/sorted", methods=["GET", "POST"])
@@ -222,22 +329,28 @@ def create_sort_app(app: Flask, config: Config):
         POST
         Remove a sorted transaction and put it back in the "to_sort" list
         """
+        session.sync(cache)
         if request.method == "POST":
             assert cache.unsorted is not None
             txn_id = request.args["txnID"]
-            idx = _index_of(cache.sorted, txn_id)
-            cache.unsorted.insert(0, cache.sorted[idx])
-            del cache.sorted[idx]
+            drs = cache.sorted.pop(txn_id)
+            cache.unsorted.push_front(drs)
             del cache.mods[txn_id]
-        max_txns = request.args.get("max", DEFAULT_MAX_TXNS)
+            cache.edits.pop(_file_name(drs), None)
+            cache.cursors.forget(txn_id)
+            session.reverted(cache, txn_id)
+        page = cache.sorted.head(_max_txns())
         return {
-            "sorted": [to_dict(drs) for drs in cache.sorted[:max_txns]],
-            "mods": {
-                drs.id: to_dict(cache.mods[drs.id]) for drs in cache.sorted[:max_txns]
-            },
+            "sorted": page,
+            "mods": {drs.id: cache.mods[drs.id] for drs in page},
         }
 
 
+def _max_txns() -> int:
+    max_txns = request.args.get("max", DEFAULT_MAX_TXNS, type=int)
+    return max(0, min(max_txns, MAX_TXNS_LIMIT))
+
+
 def _accounts(entry: Directive) -> Set[str]:
     if type(entry) is Transaction:
         return {posting.account for posting in entry.postings}
@@ -255,11 +368,84 @@ def _open_accounts(all_entries: Entries) -> Set[str]:
     return open - closed
 
 
-def _auto_categorise(config: Config, id: str, entry: Directive) -> DirectiveForSort:
-    for pat, account in config["categories"].items():
-        if pat.lower() in entry.payee.lower():
-            return DirectiveForSort(id=id, entry=entry, autocat=account)
-    return DirectiveForSort(id=id, entry=entry)
+def _auto_categorise(
+    config: Config, history: PayeeHistory, id: str, entry: Directive
+) -> DirectiveForSort:
+    """
+    The config rules win, and otherwise go with how this payee was categorised before
+    """
+    autocat = config.categories.match(entry.payee) or history.suggest(entry.payee)
+    return DirectiveForSort(id=id, entry=entry, autocat=autocat)
+
+
+def _record_history(
+    history: PayeeHistory, mods: Iterable[Tuple[DirectiveForSort, DirectiveMod]]
+):
+    """
+    Call once the mods are written, so that the next session can suggest them
+    """
+    if not history.loaded:
+        # The mods will be picked up from the ledger when it is loaded
+        return
+    for drs, mod in mods:
+        if mod.type != "replace" or mod.postings is None:
+            continue
+        entry = drs.entry
+        payee = mod.payee if mod.payee is not None else entry.payee
+        history.add(payee, [posting.account for posting in mod.postings], entry.date)
+
+
+def _write_outputs(
+    cache: Cache, history: PayeeHistory, session: SessionLog, writer: LedgerWriter
+) -> Dict[str, Tuple[str, str]]:
+    """
+    Writes the files through $writer, with all of them locked. The mods are rebased onto
+    every file before any is written, so an EditConflict leaves all the files as they were.
+    If some of the writes fail, the files that were written are dropped from the session:
+    their mods shouldn't be applied twice, and the line numbers of the entries left to
+    sort in them are out of date.
+    Returns { file name => (contents before, after) }
+    """
+    names = _names_with_mods(cache)
+    # Compiled up front, so that only the rebase is done with the files locked
+    scripts = {name: _edit_script(cache, name) for name in names}
+
+    def rebase(name: str) -> EditBatch:
+        base = cache.sources[name].splitlines()
+        return lambda lines: (rebase_edits(base, lines, scripts[name]), None)
+
+    written = writer.write_together(
+        {Path("/data") / name: rebase(name) for name in names}
+    )
+    futures = {name: written[Path("/data") / name] for name in names}
+    failed = {name: f.exception() for name, f in futures.items() if f.exception()}
+    done = set(names) - set(failed)
+    _record_history(
+        history,
+        ((cache.sorted[id], mod) for id, mod in _mods_in(cache, done)),
+    )
+    if not failed:
+        return {
+            name: (future.result().before, future.result().after)
+            for name, future in futures.items()
+        }
+    assert cache.unsorted is not None and cache.destination_files is not None
+    for id, _ in list(_mods_in(cache, done)):
+        cache.sorted.pop(id)
+        del cache.mods[id]
+    assert cache.total is not None
+    for drs in list(cache.unsorted):
+        if _file_name(drs) in done:
+            cache.unsorted.pop(drs.id)
+            cache.total -= 1
+    for name in done:
+        cache.edits.pop(name, None)
+        cache.sources.pop(name, None)
+    cache.destination_files = [n for n in cache.destination_files if n not in done]
+    session.save(cache)
+    for name, err in failed.items():
+        logging.error("Couldn't write %s: %s", name, err)
+    raise next(iter(failed.values()))
 
 
 def _rank_order(entries: List[DirectiveForSort]) -> List[DirectiveForSort]:
@@ -282,54 +468,98 @@ def _rank_order(entries: List[DirectiveForSort]) -> List[DirectiveForSort]:
     return list(chain.from_iterable(groups))
 
 
-def _create_output(cache: Cache) -> str:
-    assert cache.destination_file is not None
-    # Load destination file
-    with open(Path("/data") / cache.destination_file, "r") as dest:
-        destination_lines = dest.read().splitlines()
-    for id, mod in cache.mods.items():
-        mod_idx = _index_of(cache.sorted, id)
-        entry = cache.sorted[mod_idx]
+def _file_name(drs: DirectiveForSort) -> str:
+    return Path(drs.entry.meta["filename"]).name
+
+
+def _mods_in(cache: Cache, names: Set[str]) -> Iterable[Tuple[str, DirectiveMod]]:
+    return (
+        (id, mod)
+        for id, mod in cache.mods.items()
+        if _file_name(cache.sorted[id]) in names
+    )
+
+
+def _names_with_mods(cache: Cache) -> List[str]:
+    return sorted({_file_name(cache.sorted[id]) for id in cache.mods})
+
+
+def _formatted_outputs(cache: Cache) -> Dict[str, Tuple[str, str]]:
+    """
+    { file name => (contents now, after the mods) } for each destination file that has
+    mods. The mods are rebased onto anything written to the file since it was parsed.
+    Each file is aligned on its own, and only the edited lines are run through the
+    auto-formatter.
+    """
+    outputs = {}
+    for name in _names_with_mods(cache):
+        dest_path = Path("/data") / name
+        with open(dest_path, "r") as dest:
+            before = dest.read()
+        destination_lines = before.splitlines()
+        edits = rebase_edits(
+            cache.sources[name].splitlines(),
+            destination_lines,
+            _edit_script(cache, name),
+        )
+        after, _ = align_edits(
+            destination_lines, edits, file_widths(dest_path, destination_lines)
+        )
+        outputs[name] = (before, after)
+    return outputs
+
+
+def _edit_script(cache: Cache, name: str) -> List[Edit]:
+    """
+    The mods to $name compiled into edits of the file as it was parsed, sorted by line.
+    Kept on $cache until the mods change.
+    """
+    cached = cache.edits.get(name)
+    if cached is not None:
+        return cached
+    destination_lines = cache.sources[name].splitlines()
+    renderer = cache.renderer or DEFAULT_RENDERER
+    edits: List[Edit] = []
+    for id, mod in _mods_in(cache, {name}):
+        entry = cache.sorted[id]
         if mod.type == "replace":
             assert (
                 mod.postings is not None
                 or mod.payee is not None
                 or mod.narration is not None
             )
-            _replace_with(destination_lines, entry, mod)
+            edits.append(_replace_with(renderer, destination_lines, entry, mod))
         elif mod.type == "skip":
-            _add_skip_tag(destination_lines, entry)
+            edits.append(_add_skip_tag(renderer, destination_lines, entry))
         elif mod.type == "delete":
-            _delete_transaction(destination_lines, entry)
-    return "\n".join([l for l in destination_lines if l != DELETED_LINE])
+            edits.append(_delete_transaction(destination_lines, entry))
+    # Each edit only touches the lines of its own transaction, so they don't overlap
+    edits.sort(key=lambda edit: edit[0])
+    cache.edits[name] = edits
+    return edits
 
 
 def _is_sortable(cache: Cache, entry: Directive) -> bool:
-    assert cache.destination_file is not None
+    assert cache.destination_files is not None
     return (
         type(entry) in SUPPORTED_DIRECTIVES
         and TODO_ACCOUNT in _accounts(entry)
-        and Path(entry.meta["filename"]).name == cache.destination_file
+        and Path(entry.meta["filename"]).name in cache.destination_files
         and TAG_SKIP_SORT not in entry.tags
     )
 
 
-def _index_of(items: List[DirectiveForSort], id: str) -> int:
-    """
-    Will throw a StopIteration if it doesn't find the id
-    """
-    return next(i for i, item in enumerate(items) if item.id == id)
-
-
 def _replace_with(
-    destination_lines: List[str], drs: DirectiveForSort, mod: DirectiveMod
-):
+    renderer: EntryRenderer,
+    destination_lines: List[str],
+    drs: DirectiveForSort,
+    mod: DirectiveMod,
+) -> Edit:
     """
     Replace the todo posting with the $replacements in $destination_lines
-    We don't update $entry in cache.to_sort, because it is stored so that we can revert to it
+    $drs.entry is left as is (_replace() makes a new one), so that we can revert to it
     """
-    # We make a copy, because the original is stored later so that we can revert to it
-    entry = deepcopy(drs.entry)
+    entry = drs.entry
     lineno = entry.meta["lineno"]
     # first line + 1 line per posting
     num_lines = 1 + len(entry.postings)
@@ -343,39 +573,30 @@ def _replace_with(
         entry = entry._replace(narration=mod.narration)
     # -1 since we're going from line number to position
     replace_pos = lineno - 1
-    outs = _format_entry(destination_lines, entry, replace_pos)
-    outlines = outs.splitlines()
-    if len(outlines) > num_lines:
-        outlines[num_lines - 1 :] = ["\n".join(outlines[num_lines - 1 :])]
-    assert len(outlines) <= num_lines
-    destination_lines[replace_pos : replace_pos + num_lines] = outlines
+    outs = renderer.render(entry, indentation_at(destination_lines[replace_pos]))
+    return (replace_pos, replace_pos + num_lines, outs.splitlines())
 
 
-def _add_skip_tag(destination_lines: List[str], drs: DirectiveForSort):
-    # We make a copy, because the original is stored later so that we can revert to it
-    entry = deepcopy(drs.entry)
+def _add_skip_tag(
+    renderer: EntryRenderer, destination_lines: List[str], drs: DirectiveForSort
+) -> Edit:
+    entry = drs.entry
     lineno = entry.meta["lineno"]
     entry = entry._replace(tags=(entry.tags or set()).union({TAG_SKIP_SORT}))
     # -1 since we're going from line number to position
     replace_pos = lineno - 1
-    outs = _format_entry(destination_lines, entry, replace_pos)
+    outs = renderer.render(entry, indentation_at(destination_lines[replace_pos]))
     # Only want the first line, because that's where the tag will go
-    destination_lines[replace_pos] = outs.splitlines()[0]
-
-
-def _format_entry(destination_lines: List[str], entry: Directive, pos: int):
-    indent = indentation_at(destination_lines[pos])
-    formatted = printer.format_entry(entry, DISPLAY_CONTEXT)
-    return textwrap.indent(formatted, indent)
+    return (replace_pos, replace_pos + 1, outs.splitlines()[:1])
 
 
-def _delete_transaction(destination_lines: List[str], drs: DirectiveForSort):
+def _delete_transaction(destination_lines: List[str], drs: DirectiveForSort) -> Edit:
     lineno = drs.entry.meta["lineno"]
     # -1 since we're going from line number to position
     rm_pos = lineno - 1
-    # transaction header; postings; newline
-    rm_num = 1 + len(drs.entry.postings) + 1
-    # note that I cannot just remove these lines because then all subsequent line
-    # number lookups from "entry.meta" will be off
-    # So I remove these later in _create_output()
-    destination_lines[rm_pos : rm_pos + rm_num] = [DELETED_LINE] * rm_num
+    # transaction header; postings
+    rm_end = rm_pos + 1 + len(drs.entry.postings)
+    # and the blank line after it
+    if rm_end < len(destination_lines) and destination_lines[rm_end].strip() == "":
+        rm_end += 1
+    return (rm_pos, rm_end, [])
@@ -1,22 +1,129 @@
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from itertools import islice
+import secrets
+from typing import Container, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+from beancount.core.data import Transaction
+
+from .alignment import Edit
+from .formatting import EntryRenderer
 from .serialise import DirectiveForSort, DirectiveMod
+from .sort_link import AmountIndex
+
+
+class EntryQueue:
+    """
+    Entries in the order they're shown in, indexed by id.
+    Looking up, removing, and adding at either end are all O(1).
+    """
+
+    _items: "OrderedDict[str, DirectiveForSort]"  # { drs.id => drs }
+
+    def __init__(self, items: Iterable[DirectiveForSort] = ()) -> None:
+        self._items = OrderedDict((item.id, item) for item in items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[DirectiveForSort]:
+        return iter(self._items.values())
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._items
+
+    def __getitem__(self, id: str) -> DirectiveForSort:
+        return self._items[id]
+
+    def head(self, n: int, skip: Container[str] = ()) -> List[DirectiveForSort]:
+        """
+        The first $n, leaving out the ids in $skip
+        """
+        return list(
+            islice((item for item in self._items.values() if item.id not in skip), n)
+        )
+
+    def pop(self, id: str) -> DirectiveForSort:
+        return self._items.pop(id)
+
+    def append(self, item: DirectiveForSort):
+        self._items[item.id] = item
+
+    def push_front(self, item: DirectiveForSort):
+        self._items[item.id] = item
+        self._items.move_to_end(item.id, last=False)
+
+
+# How many clients to remember what was sent to
+MAX_CURSORS = 8
+
+
+class Cursors:
+    """
+    The ids that have been sent to each client, so that it's only sent the entries that
+    it doesn't have yet. A client whose cursor has been forgotten (or is from an older
+    session) gets a new one, and starts over.
+    """
+
+    _delivered: "OrderedDict[str, Set[str]]"  # { cursor => drs.ids sent }
+
+    def __init__(self) -> None:
+        self._delivered = OrderedDict()
+
+    def get(self, cursor: Optional[str]) -> Tuple[str, Set[str]]:
+        if cursor is not None and cursor in self._delivered:
+            self._delivered.move_to_end(cursor)
+            return cursor, self._delivered[cursor]
+        cursor = secrets.token_urlsafe(8)
+        self._delivered[cursor] = set()
+        if len(self._delivered) > MAX_CURSORS:
+            self._delivered.popitem(last=False)
+        return cursor, self._delivered[cursor]
+
+    def mark(self, cursor: Optional[str], ids: Iterable[str]):
+        """
+        $ids have been sent to the client with $cursor
+        """
+        if cursor is not None and cursor in self._delivered:
+            self._delivered[cursor].update(ids)
+
+    def forget(self, id: str):
+        """
+        Send $id again, eg. once it's back in unsorted
+        """
+        for delivered in self._delivered.values():
+            delivered.discard(id)
 
 
 class Cache:
     op: Optional[str] = None
-    destination_file: Optional[str] = None
-    unsorted: Optional[List[DirectiveForSort]] = None
+    # The files to sort the TODOs of, the mods are written back to each of them
+    destination_files: Optional[List[str]] = None
+    # { file name => contents when it was parsed }, what the entries' line numbers are for
+    sources: Dict[str, str] = {}
+    unsorted: Optional[EntryQueue] = None
     accounts: Optional[List[str]] = None
     total: Optional[int] = None
-    sorted: List[DirectiveForSort] = []
+    sorted: EntryQueue = EntryQueue()
     mods: Dict[str, DirectiveMod] = {}  # { mod.id => mod }
+    # { file name => the mods compiled into edits of its sources }
+    edits: Dict[str, List[Edit]] = {}
+    links: Optional[AmountIndex[str]] = None  # unsorted amounts => drs.id
+    ledger_links: Optional[AmountIndex[Transaction]] = None
+    cursors: Cursors = Cursors()
+    # Renders with the precision of the ledger the entries came from
+    renderer: Optional[EntryRenderer] = None
 
     def reset(self):
         self.op = None
-        self.destination_file = None
+        self.destination_files = None
+        self.sources = {}
         self.unsorted = None
         self.accounts = None
         self.total = None
-        self.sorted = []
+        self.sorted = EntryQueue()
         self.mods = {}
+        self.edits = {}
+        self.links = None
+        self.ledger_links = None
+        self.cursors = Cursors()
+        self.renderer = None
@@ -0,0 +1,151 @@
+from collections import defaultdict, deque
+from datetime import date
+import re
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional
+
+from beancount.core.data import Entries, Transaction
+
+from .utilities import TODO_ACCOUNT
+
+
+class PayeeMatcher:
+    """
+    Matches a payee against all the `categories` patterns in one pass (Aho-Corasick), instead
+    of trying every pattern in turn. Patterns are case-insensitive substrings of the payee,
+    and when several match, the first one in config order wins -- same as checking them
+    one by one.
+    """
+
+    _accounts: List[str]  # in config order
+    _goto: List[Dict[str, int]]  # { node => { char => next node } }
+    _fail: List[int]  # { node => longest proper suffix that is also a node }
+    _first: List[Optional[int]]  # { node => lowest pattern index that ends here }
+    _memo: Dict[str, Optional[str]]  # { payee => account }
+
+    def __init__(self, categories: Dict[str, str]) -> None:
+        self._accounts = list(categories.values())
+        self._goto = [{}]
+        self._first = [None]
+        for idx, pattern in enumerate(categories):
+            node = 0
+            for ch in pattern.lower():
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._first.append(None)
+                node = nxt
+            if self._first[node] is None:
+                self._first[node] = idx
+        self._fail = [0] * len(self._goto)
+        self._link()
+        self._memo = {}
+
+    def _link(self):
+        # Breadth first, so that a node's suffix is done before the node itself
+        queue: Deque[int] = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            # Matching here also matches everything that ends at the suffix
+            self._first[node] = _lowest(
+                self._first[node], self._first[self._fail[node]]
+            )
+            for ch, nxt in self._goto[node].items():
+                fail = self._fail[node]
+                while fail > 0 and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                queue.append(nxt)
+
+    def match(self, payee: Optional[str]) -> Optional[str]:
+        """
+        The account of the first pattern that $payee contains, if any
+        """
+        payee = payee or ""
+        if payee in self._memo:
+            return self._memo[payee]
+        best = self._first[0]
+        node = 0
+        for ch in payee.lower():
+            if best == 0:
+                break
+            while node > 0 and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            best = _lowest(best, self._first[node])
+        account = self._accounts[best] if best is not None else None
+        self._memo[payee] = account
+        return account
+
+
+def _lowest(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class PayeeHistory:
+    """
+    How each payee has been categorised before: { normalised payee => { account => stats } }.
+    Built from the ledger once, and then kept up to date with each commit.
+    The first posting of an imported transaction is the account it was imported into
+    (see collect_plaid), so only the postings after it count as categorisations.
+    """
+
+    _stats: Dict[str, Dict[str, "AccountStats"]]
+    loaded: bool
+
+    def __init__(self) -> None:
+        self._stats = defaultdict(dict)
+        self.loaded = False
+
+    def load(self, entries: Entries):
+        for entry in entries:
+            if type(entry) is not Transaction or len(entry.postings) < 2:
+                continue
+            accounts = [posting.account for posting in entry.postings[1:]]
+            if TODO_ACCOUNT in accounts:
+                continue
+            self.add(entry.payee, accounts, entry.date)
+        self.loaded = True
+
+    def add(self, payee: Optional[str], accounts: Iterable[str], when: date):
+        key = normalise_payee(payee)
+        if not key:
+            return
+        stats = self._stats[key]
+        for account in set(accounts):
+            if account == TODO_ACCOUNT:
+                continue
+            if account in stats:
+                stats[account] = stats[account].seen(when)
+            else:
+                stats[account] = AccountStats(count=1, last=when)
+
+    def suggest(self, payee: Optional[str]) -> Optional[str]:
+        """
+        The account most often used for $payee, the most recent one on ties
+        """
+        stats = self._stats.get(normalise_payee(payee))
+        if not stats:
+            return None
+        return max(stats.items(), key=lambda kv: (kv[1].count, kv[1].last))[0]
+
+
+class AccountStats(NamedTuple):
+    count: int
+    last: date
+
+    def seen(self, when: date) -> "AccountStats":
+        return AccountStats(count=self.count + 1, last=max(self.last, when))
+
+
+# Card processors tack on store numbers, references, and the like
+NOISE_RE = re.compile(r"[\d#*]+")
+
+
+def normalise_payee(payee: Optional[str]) -> str:
+    return " ".join(NOISE_RE.sub(" ", (payee or "").lower()).split())
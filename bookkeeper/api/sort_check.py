@@ -0,0 +1,339 @@
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass, field
+import glob
+from hashlib import sha1
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+from pathlib import Path
+from threading import Lock
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+
+from beancount import loader
+from beancount.core import data
+from beancount.ops import validation
+from beancount.parser import booking, parser, printer
+
+# How many check results to remember
+RESULTS_CACHE_SIZE = 16
+
+# { hash of error => formatted error }
+CheckErrors = Dict[str, str]
+
+
+class Cancelled(Exception):
+    pass
+
+
+@dataclass
+class Loaded:
+    """
+    What a load read (apart from the overlays), so it can tell whether it's still current
+    """
+
+    # { filename => (mtime_ns, size), None if it didn't exist }
+    files: Dict[str, Optional[Tuple[int, int]]] = field(default_factory=dict)
+    # { include glob => the files it matched }
+    globs: Dict[str, List[str]] = field(default_factory=dict)
+
+    def unchanged(self) -> bool:
+        return all(_stamp(f) == stamp for f, stamp in self.files.items()) and all(
+            _glob(pattern) == matched for pattern, matched in self.globs.items()
+        )
+
+
+class OverlayLoader:
+    """
+    Loads the ledger the same way loader.load_file() does, except that the contents of
+    some files can be overridden in memory. Files that haven't changed on disk since the
+    last load aren't parsed again. Booking and the plugins can modify the parsed entries
+    (eg. the meta of interpolated postings), so each load works on its own copy of them.
+    """
+
+    # { filename => ((mtime_ns, size), (entries, errors, options_map)) }
+    _parsed: Dict[str, Tuple[Tuple[int, int], Tuple[List, List, Dict]]]
+    loaded: Loaded  # by the last load
+
+    def __init__(self) -> None:
+        self._parsed = {}
+        self.loaded = Loaded()
+
+    def load(
+        self, main_file: str, overlays: Dict[str, str], cancel: Any = None
+    ) -> Tuple[List, List, Dict]:
+        """
+        Same as loader._load(), with the contents of the files in $overlays replaced.
+        Gives up with Cancelled between steps if $cancel is set.
+        """
+
+        def checkpoint():
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+
+        self.loaded = Loaded()
+        entries, errors, options_map = self._parse_recursive(
+            main_file, overlays, checkpoint
+        )
+        if options_map["plugin"]:
+            # They can change anything
+            entries = deepcopy(entries)
+        else:
+            entries = _copy_meta(entries)
+        entries.sort(key=data.entry_sortkey)
+        checkpoint()
+        entries, balance_errors = booking.book(entries, options_map)
+        errors.extend(balance_errors)
+        checkpoint()
+        entries, errors = loader.run_transformations(entries, errors, options_map, None)
+        checkpoint()
+        errors.extend(
+            validation.validate(
+                entries,
+                options_map,
+                None,
+                # Force slow and hardcore validations.
+                validation.HARDCORE_VALIDATIONS,
+            )
+        )
+        return entries, errors, options_map
+
+    def _parse_recursive(
+        self, main_file: str, overlays: Dict[str, str], checkpoint
+    ) -> Tuple[List, List, Dict]:
+        # Follows loader._parse_recursive()
+        entries: List = []
+        errors: List = []
+        options_map: Optional[Dict] = None
+        stack = [os.path.normpath(main_file)]
+        seen = set()
+        while stack:
+            filename = stack.pop(0)
+            checkpoint()
+            if filename in seen:
+                errors.append(
+                    loader.LoadError(
+                        data.new_metadata("<load>", 0),
+                        'Duplicate filename parsed: "{}"'.format(filename),
+                        None,
+                    )
+                )
+                continue
+            if filename not in overlays and not os.path.exists(filename):
+                self.loaded.files[filename] = None
+                errors.append(
+                    loader.LoadError(
+                        data.new_metadata("<load>", 0),
+                        'File "{}" does not exist'.format(filename),
+                        None,
+                    )
+                )
+                continue
+            seen.add(filename)
+            src_entries, src_errors, src_options_map = self._parse(
+                filename, overlays.get(filename)
+            )
+            entries.extend(src_entries)
+            errors.extend(src_errors)
+            if options_map is None:
+                # Copied, since it gets added to below
+                options_map = deepcopy(src_options_map)
+            else:
+                loader.aggregate_options_map(options_map, src_options_map)
+            cwd = os.path.dirname(filename)
+            for include in src_options_map["include"]:
+                pattern = os.path.join(cwd, include)
+                matched = _glob(pattern)
+                self.loaded.globs[pattern] = matched
+                if not matched:
+                    errors.append(
+                        loader.LoadError(
+                            data.new_metadata("<load>", 0),
+                            'File glob "{}" does not match any files'.format(include),
+                            None,
+                        )
+                    )
+                stack.extend(os.path.normpath(match) for match in matched)
+        assert options_map is not None
+        options_map["include"] = sorted(seen)
+        return entries, errors, options_map
+
+    def _parse(self, filename: str, contents: Optional[str]) -> Tuple[List, List, Dict]:
+        if contents is not None:
+            return parser.parse_string(contents, filename)
+        stamp = _stamp(filename)
+        assert stamp is not None
+        self.loaded.files[filename] = stamp
+        cached = self._parsed.get(filename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        parsed = parser.parse_file(filename)
+        self._parsed[filename] = (stamp, parsed)
+        return parsed
+
+
+def _copy_meta(entries: List) -> List:
+    """
+    Copies of $entries with their own meta, and postings. Enough for booking, which only
+    modifies those, and is much quicker than deepcopy().
+    """
+    copies = []
+    for entry in entries:
+        if isinstance(entry, data.Transaction):
+            postings = [
+                posting._replace(meta=dict(posting.meta))
+                if posting.meta is not None
+                else posting
+                for posting in entry.postings
+            ]
+            entry = entry._replace(meta=dict(entry.meta), postings=postings)
+        elif entry.meta is not None:
+            entry = entry._replace(meta=dict(entry.meta))
+        copies.append(entry)
+    return copies
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _glob(pattern: str) -> List[str]:
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def format_errors(errors: List) -> CheckErrors:
+    def hash_error(error):
+        h = sha1(error.source["filename"].encode())
+        h.update(str(error.source["lineno"]).encode())
+        h.update(error.message.encode())
+        return h.hexdigest()
+
+    return {hash_error(error): printer.format_error(error) for error in errors}
+
+
+def _serve(conn: Connection, cancel: Any):
+    """
+    Runs in the worker process. Keeps the parsed files around between checks.
+    """
+    overlay_loader = OverlayLoader()
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        main_file, overlays = job
+        try:
+            _, errors, _ = overlay_loader.load(main_file, overlays, cancel)
+            conn.send(("ok", (format_errors(errors), overlay_loader.loaded)))
+        except Cancelled:
+            conn.send(("cancelled", None))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+class LedgerChecker:
+    """
+    Runs bean-check on the ledger, with some files' contents replaced, in a worker process.
+    Only one check runs at a time, and starting a new one cancels the one in progress.
+    Results are remembered by the contents checked, for as long as the other files that
+    were loaded for them haven't changed.
+    """
+
+    _ctx: Any
+    _process: Optional[Any]
+    _conn: Optional[Connection]
+    _cancel: Any
+    _lock: Lock  # held while a check is running
+    _latest: int  # the newest check, all the others are superseded
+    _results: "OrderedDict[str, Tuple[Loaded, CheckErrors]]"
+    _results_lock: Lock
+
+    def __init__(self) -> None:
+        # Not fork, since this is a threaded server
+        self._ctx = multiprocessing.get_context("spawn")
+        self._process = None
+        self._conn = None
+        self._cancel = self._ctx.Event()
+        self._lock = Lock()
+        self._latest = 0
+        self._results = OrderedDict()
+        self._results_lock = Lock()
+
+    def check(
+        self, main_file: Path, overlays: Dict[Path, str]
+    ) -> Optional[CheckErrors]:
+        """
+        Returns the errors, or None if a newer check cancelled this one.
+        $overlays is { file => contents to check instead of what's on disk }
+        """
+        key = self._key(main_file, overlays)
+        with self._results_lock:
+            cached = self._results.get(key)
+        if cached is not None and cached[0].unchanged():
+            with self._results_lock:
+                if key in self._results:
+                    self._results.move_to_end(key)
+            return cached[1]
+        with self._results_lock:
+            self._latest += 1
+            generation = self._latest
+        # Tell the running check (if any) to give up, and wait for it to stop
+        self._cancel.set()
+        with self._lock:
+            if generation != self._latest:
+                # An even newer check came in while we were waiting
+                return None
+            self._cancel.clear()
+            status, result = self._run(
+                str(main_file),
+                {str(path): contents for path, contents in overlays.items()},
+            )
+        if status == "cancelled":
+            return None
+        if status == "error":
+            raise RuntimeError(result)
+        errors, loaded = result
+        with self._results_lock:
+            self._results[key] = (loaded, errors)
+            self._results.move_to_end(key)
+            if len(self._results) > RESULTS_CACHE_SIZE:
+                self._results.popitem(last=False)
+        return errors
+
+    def _run(self, main_file: str, overlays: Dict[str, str]) -> Tuple[str, Any]:
+        if self._process is None or not self._process.is_alive():
+            self._start()
+        assert self._conn is not None
+        try:
+            self._conn.send((main_file, overlays))
+            return self._conn.recv()
+        except (EOFError, OSError):
+            logging.warning("Check worker died, restarting it")
+            self._process = None
+            raise
+
+    def _start(self):
+        self._conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(
+            target=_serve,
+            args=(child_conn, self._cancel),
+            name="ledger-check",
+            daemon=True,
+        )
+        self._process.start()
+
+    def _key(self, main_file: Path, overlays: Dict[Path, str]) -> str:
+        """
+        The contents being checked. Whether the other files changed is up to Loaded, since
+        only the load knows which files are included.
+        """
+        h = sha1(str(main_file).encode())
+        for path in sorted(overlays):
+            h.update(str(path).encode())
+            h.update(overlays[path].encode())
+        return h.hexdigest()
@@ -0,0 +1,91 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+from decimal import Decimal
+from typing import Generic, Iterable, List, Optional, Tuple, TypeVar
+
+from beancount.core.data import Directive, Entries, Transaction
+
+from .utilities import TODO_ACCOUNT
+
+K = TypeVar("K")
+
+# Same as the old linear search: amounts have to be less than a cent apart
+DEFAULT_TOLERANCE = Decimal("0.01")
+# How far back before the oldest TODO to look for already categorised transfers
+LEDGER_LINK_DAYS = 90
+
+
+class AmountIndex(Generic[K]):
+    """
+    Postings sorted by their absolute amount, so that the ones close to an amount
+    can be found by bisecting, instead of comparing against every posting.
+    """
+
+    _numbers: List[Decimal]
+    _items: List[Tuple[date, K]]  # same order as _numbers
+
+    def __init__(self, postings: Iterable[Tuple[Decimal, date, K]]) -> None:
+        rows = sorted(
+            ((abs(number), when, key) for number, when, key in postings),
+            key=lambda row: row[0],
+        )
+        self._numbers = [number for number, _, _ in rows]
+        self._items = [(when, key) for _, when, key in rows]
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def near(
+        self,
+        amount: Decimal,
+        tolerance: Decimal = DEFAULT_TOLERANCE,
+        around: Optional[date] = None,
+        days: Optional[int] = None,
+    ) -> List[K]:
+        """
+        Keys of the postings whose absolute amount is less than $tolerance away from $amount's.
+        With $around, the closest dates come first, and $days limits how far away they can be.
+        """
+        number = abs(amount)
+        # Strictly less than $tolerance away
+        lo = bisect_right(self._numbers, number - tolerance)
+        hi = bisect_left(self._numbers, number + tolerance)
+        found: List[Tuple[int, int, K]] = []
+        for i in range(lo, hi):
+            when, key = self._items[i]
+            distance = abs((when - around).days) if around is not None else 0
+            if days is not None and distance > days:
+                continue
+            found.append((distance, i, key))
+        found.sort(key=lambda row: (row[0], row[1]))
+        keys: List[K] = []
+        seen = set()
+        for _, _, key in found:
+            # One entry can have several postings of the same amount.
+            # Each entry's postings share the same key object.
+            if id(key) not in seen:
+                seen.add(id(key))
+                keys.append(key)
+        return keys
+
+
+def entry_postings(entry: Directive) -> List[Tuple[Decimal, date]]:
+    return [
+        (posting.units.number, entry.date)
+        for posting in entry.postings
+        if posting.units is not None and posting.units.number is not None
+    ]
+
+
+def ledger_index(entries: Entries, since: date) -> AmountIndex[Transaction]:
+    """
+    Index of the transactions since $since that are already categorised
+    """
+    return AmountIndex(
+        (number, when, entry)
+        for entry in entries
+        if type(entry) is Transaction
+        and entry.date >= since
+        and all(posting.account != TODO_ACCOUNT for posting in entry.postings)
+        for number, when in entry_postings(entry)
+    )
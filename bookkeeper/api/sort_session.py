@@ -0,0 +1,218 @@
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from beancount.core.compare import hash_entry
+from beancount.core.data import Directive
+
+from .serialise import DirectiveForSort, DirectiveMod, mod_from_dict, to_json
+from .sort_cache import Cache
+
+# Next to the ledger, so that it survives the container being restarted
+SESSION_LOG = ".sort-session.log"
+
+# Records in the log, one JSON array per line:
+#   ["session", state] -- the session, always the first record. Only the ids and keys (see
+#     entry_key()) of its entries, and the mods, the rest comes from parsing the ledger.
+#   ["sorted", [mod, ...]] -- the entries for these mods moved from unsorted to sorted
+#   ["reverted", id] -- the entry moved back from sorted to unsorted
+Record = Tuple[str, Any]
+
+# [(drs.id, entry_key(drs.entry)), ...] in the order they're in
+EntryKeys = List[Tuple[str, str]]
+
+# Parses the destination files of the session in the cache, and fills in its entries.
+# Given the unsorted and sorted EntryKeys of a logged session, it's only those entries,
+# with the ids they had, in the same order.
+Loader = Callable[[Cache, Optional[Tuple[EntryKeys, EntryKeys]]], None]
+
+
+class SessionLog:
+    """
+    The sort session (see Cache) as an append-only log of JSON records, so that it
+    outlives the process, and other worker processes can pick it up.
+    Only what can't be worked out again is logged: which entries are in the session, and
+    the mods. Replaying it parses the ledger with $load, but doesn't need to rank the
+    entries again. The entries are found by their contents, so the destination files can
+    change in the meantime. The log is compacted into a single record when the session is
+    started, and removed once it is committed.
+    """
+
+    path: Path
+    _load: Loader
+    _offset: int  # how much of the log has been applied to the cache
+    _inode: Optional[int]  # compacting replaces the file
+    _lock: Lock
+
+    def __init__(self, path: Path, load: Loader) -> None:
+        self.path = path
+        self._load = load
+        self._offset = 0
+        self._inode = None
+        self._lock = Lock()
+
+    def sync(self, cache: Cache):
+        """
+        Applies the records that aren't in $cache yet, which were written before a restart,
+        or by another process.
+        """
+        with self._lock:
+            try:
+                st = self.path.stat()
+            except FileNotFoundError:
+                if self._inode is not None:
+                    # Committed or reset elsewhere
+                    cache.reset()
+                    self._offset = 0
+                    self._inode = None
+                return
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._replay(cache, st.st_ino)
+            elif st.st_size > self._offset:
+                self._read_from(cache, self._offset)
+
+    def save(self, cache: Cache):
+        """
+        Replaces the log with a single record of the whole session in $cache
+        """
+        state: Dict[str, Any] = {
+            "op": cache.op,
+            "destination_files": cache.destination_files,
+            "unsorted": (
+                _entry_keys(cache.unsorted) if cache.unsorted is not None else None
+            ),
+            "sorted": _entry_keys(cache.sorted),
+            "total": cache.total,
+            "mods": list(cache.mods.values()),
+        }
+        data = _encode(("session", state))
+        with self._lock:
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._offset = len(data)
+            self._inode = self.path.stat().st_ino
+
+    def sorted(self, cache: Cache, mods: List[DirectiveMod]):
+        self._append(cache, ("sorted", mods))
+
+    def reverted(self, cache: Cache, id: str):
+        self._append(cache, ("reverted", id))
+
+    def clear(self):
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+            self._offset = 0
+            self._inode = None
+
+    def _append(self, cache: Cache, record: Record):
+        """
+        $record has already been applied to $cache
+        """
+        data = _encode(record)
+        with self._lock:
+            with open(self.path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                st = os.fstat(f.fileno())
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if st.st_ino == self._inode and st.st_size == self._offset:
+                self._offset += len(data)
+            else:
+                # Someone else wrote to the log in the meantime, so it's the log that's right
+                self._replay(cache, st.st_ino)
+
+    def _replay(self, cache: Cache, inode: int):
+        cache.reset()
+        self._offset = 0
+        self._inode = inode
+        self._read_from(cache, 0)
+
+    def _read_from(self, cache: Cache, offset: int):
+        with open(self.path, "r+b") as f:
+            # So that nobody is halfway through appending
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(offset)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("No end of line")
+                    record = json.loads(line)
+                except ValueError:
+                    # Half written when the process died, everything before it is good
+                    logging.warning("Dropping the torn end of %s", self.path)
+                    f.truncate(self._offset)
+                    break
+                self._apply(cache, record)
+                self._offset += len(line)
+
+    def _apply(self, cache: Cache, record: Record):
+        kind, value = record
+        if kind == "session":
+            cache.reset()
+            cache.op = value["op"]
+            cache.destination_files = value["destination_files"]
+            if value["unsorted"] is None:
+                return
+            unsorted_keys = [(id, key) for id, key in value["unsorted"]]
+            sorted_keys = [(id, key) for id, key in value["sorted"]]
+            self._load(cache, (unsorted_keys, sorted_keys))
+            assert cache.unsorted is not None
+            # Entries that were changed in the meantime aren't in the ledger any more
+            missing = (
+                len(unsorted_keys)
+                + len(sorted_keys)
+                - len(cache.unsorted)
+                - len(cache.sorted)
+            )
+            if missing > 0:
+                logging.warning(
+                    "%d entries of the sort session aren't in the ledger any more",
+                    missing,
+                )
+            cache.total = value["total"] - missing
+            mods = (mod_from_dict(mod) for mod in value["mods"])
+            cache.mods = {mod.id: mod for mod in mods if mod.id in cache.sorted}
+        elif cache.unsorted is None:
+            # Nothing to sort or revert, the log was cleared in between
+            return
+        elif kind == "sorted":
+            for mod in map(mod_from_dict, value):
+                if mod.id in cache.unsorted:
+                    cache.sorted.append(cache.unsorted.pop(mod.id))
+                if mod.id in cache.sorted:
+                    cache.mods[mod.id] = mod
+            cache.edits = {}
+        elif kind == "reverted":
+            if value in cache.sorted:
+                cache.unsorted.push_front(cache.sorted.pop(value))
+                del cache.mods[value]
+            cache.edits = {}
+        else:
+            raise RuntimeError(f"Unexpected record in the sort session log: {kind}")
+
+
+def entry_key(entry: Directive) -> str:
+    """
+    Identifies $entry by its file and contents, so it can be found again after the file
+    has been parsed again, even if its line number has changed
+    """
+    return "{}:{}".format(
+        Path(entry.meta["filename"]).name, hash_entry(entry, exclude_meta=True)
+    )
+
+
+def _entry_keys(entries: Iterable[DirectiveForSort]) -> EntryKeys:
+    return [(drs.id, entry_key(drs.entry)) for drs in entries]
+
+
+def _encode(record: Record) -> bytes:
+    return (to_json(record) + "\n").encode()
@@ -1,13 +1,60 @@
-from beancount import loader
-from beancount.core.data import Entries
+from difflib import unified_diff
+from hashlib import sha1
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Union
 
 
 # Name of metadata field to be set to indicate that the entry is a likely duplicate.
 DUPLICATE_META = "__duplicate__"
 # Temporary account used by Sorting later to know which txns to pull out
 TODO_ACCOUNT = "Equity:TODO"
+# Lines of context around each change in the diffs sent to the client
+DEFAULT_DIFF_CONTEXT = 3
 
 
-def parse_journal(fname: str) -> Entries:
-    entries, _errors, _options_map = loader.load_file(fname)
-    return entries
+def write_atomically(path: Path, contents: Union[str, bytes]):
+    """
+    Write to a temp file next to $path and rename it over, so that readers
+    never see a half-written ledger.
+    """
+    with NamedTemporaryFile(
+        "wb" if isinstance(contents, bytes) else "w",
+        dir=path.parent,
+        prefix=f".{path.name}.",
+        delete=False,
+    ) as tmp:
+        tmp.write(contents)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    if path.exists():
+        # Keep the permissions of the file being replaced
+        os.chmod(tmp.name, path.stat().st_mode)
+    os.replace(tmp.name, path)
+
+
+def content_hash(contents: str) -> str:
+    return sha1(contents.encode()).hexdigest()
+
+
+def text_diff(
+    before: str, after: str, name: str, context: int = DEFAULT_DIFF_CONTEXT
+) -> str:
+    """
+    Unified diff from $before to $after, with $context lines around each change.
+    A last line without a newline is marked the way git does, so that it doesn't run
+    into the next line of the diff.
+    """
+    lines = []
+    for line in unified_diff(
+        before.splitlines(keepends=True),
+        after.splitlines(keepends=True),
+        fromfile=f"a/{name}",
+        tofile=f"b/{name}",
+        n=context,
+    ):
+        if not line.endswith("\n"):
+            line += "\n\\ No newline at end of file\n"
+        lines.append(line)
+    return "".join(lines)
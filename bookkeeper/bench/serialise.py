@@ -0,0 +1,45 @@
+"""
+Compares to_json() against Flask encoding to_dict(), which is what the sort endpoints
+used to do, on the transactions of a ledger.
+
+From the bookkeeper directory:
+python3 -m bench.serialise /data/main.beancount
+"""
+
+import json
+import sys
+import timeit
+
+from beancount import loader
+from beancount.core.data import Transaction
+from flask import Flask
+
+from api.serialise import DirectiveForSort, to_dict, to_json
+
+REPEAT = 5
+
+
+def main(ledger_file: str):
+    entries, _, _ = loader.load_file(ledger_file)
+    items = [
+        DirectiveForSort(id=str(i), entry=entry)
+        for i, entry in enumerate(entries)
+        if type(entry) is Transaction
+    ]
+    app = Flask(__name__)
+
+    def via_dicts() -> str:
+        return app.json.dumps({"to_sort": [to_dict(drs) for drs in items]})
+
+    def direct() -> str:
+        return to_json({"to_sort": items})
+
+    assert json.loads(via_dicts()) == json.loads(direct()), "Different output"
+    print(f"{len(items)} transactions, best of {REPEAT}")
+    for name, fn in [("to_dict + json.dumps", via_dicts), ("to_json", direct)]:
+        best = min(timeit.repeat(fn, number=1, repeat=REPEAT))
+        print(f"{name:>22}: {best * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
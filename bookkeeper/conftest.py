@@ -0,0 +1 @@
+# Here so that pytest puts this directory on the path, and the tests can import api
@@ -0,0 +1,180 @@
+"""
+A stand-in for the bits of Plaid's API that the collector uses, /transactions/sync and
+/accounts/get, served locally. Point the collector at it with the "plaid.host" config.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+ACCOUNT_ID = "acc-checking"
+
+
+def transaction(
+    id: str, date: str, amount: float, name: str, pending: bool = False, **fields: Any
+) -> Dict[str, Any]:
+    """
+    A Plaid transaction, with everything that plaid-python insists on
+    """
+    txn: Dict[str, Any] = {
+        "transaction_id": id,
+        "account_id": ACCOUNT_ID,
+        "amount": amount,
+        "iso_currency_code": "USD",
+        "unofficial_currency_code": None,
+        "date": date,
+        "name": name,
+        "pending": pending,
+        "pending_transaction_id": None,
+        "category": None,
+        "category_id": None,
+        "location": {
+            key: None
+            for key in (
+                "address",
+                "city",
+                "region",
+                "postal_code",
+                "country",
+                "lat",
+                "lon",
+                "store_number",
+            )
+        },
+        "payment_meta": {
+            key: None
+            for key in (
+                "reference_number",
+                "ppd_id",
+                "payee",
+                "by_order_of",
+                "payer",
+                "payment_method",
+                "payment_processor",
+                "reason",
+            )
+        },
+        "account_owner": None,
+        "transaction_type": "place",
+        "payment_channel": "in store",
+        "authorized_date": None,
+        "authorized_datetime": None,
+        "datetime": None,
+        "transaction_code": None,
+        "merchant_name": None,
+        "check_number": None,
+    }
+    txn.update(fields)
+    return txn
+
+
+class PlaidStub:
+    """
+    Serves the $pages of /transactions/sync in order: the cursor is just the number of
+    pages sent so far. Each page is { "added", "modified", "removed" } (all optional).
+    An error in $errors is sent instead of the response to that request (counting from 0).
+    """
+
+    pages: List[Dict[str, List[Any]]]
+    balance: float
+    errors: Dict[int, Tuple[int, str]]  # { request number => (status, error_code) }
+    requests: List[Tuple[str, Dict[str, Any]]]  # (path, body)
+    _server: ThreadingHTTPServer
+
+    def __init__(self, pages: List[Dict[str, List[Any]]], balance: float = 100.0):
+        self.pages = pages
+        self.balance = balance
+        self.errors = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, response = stub.respond(self.path, body)
+                stub.requests.append((self.path, body))
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def host(self) -> str:
+        return "http://127.0.0.1:{}".format(self._server.server_port)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def sync_cursors(self) -> List[Optional[str]]:
+        """
+        The cursor of each /transactions/sync request
+        """
+        return [
+            body.get("cursor")
+            for path, body in self.requests
+            if path == "/transactions/sync"
+        ]
+
+    def respond(self, path: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        if len(self.requests) in self.errors:
+            status, error_code = self.errors[len(self.requests)]
+            return status, {
+                "error_type": "TRANSACTIONS_ERROR",
+                "error_code": error_code,
+                "error_message": error_code,
+                "display_message": None,
+                "request_id": "stub",
+            }
+        if path == "/transactions/sync":
+            sent = int(body.get("cursor") or 0)
+            page = self.pages[sent] if sent < len(self.pages) else {}
+            return 200, {
+                "added": page.get("added", []),
+                "modified": page.get("modified", []),
+                "removed": [{"transaction_id": id} for id in page.get("removed", [])],
+                "next_cursor": str(min(sent + 1, len(self.pages))),
+                "has_more": sent + 1 < len(self.pages),
+                "request_id": "stub",
+            }
+        if path == "/accounts/get":
+            return 200, {
+                "accounts": [
+                    {
+                        "account_id": ACCOUNT_ID,
+                        "balances": {
+                            "available": None,
+                            "current": self.balance,
+                            "limit": None,
+                            "iso_currency_code": "USD",
+                            "unofficial_currency_code": None,
+                        },
+                        "mask": "0000",
+                        "name": "Checking",
+                        "official_name": None,
+                        "type": "depository",
+                        "subtype": "checking",
+                    }
+                ],
+                "item": {
+                    "item_id": "item",
+                    "institution_id": "ins_stub",
+                    "webhook": "",
+                    "error": None,
+                    "available_products": [],
+                    "billed_products": [],
+                    "consent_expiration_time": None,
+                    "update_type": "background",
+                },
+                "request_id": "stub",
+            }
+        return 404, {"error_code": "NOT_FOUND", "request_id": "stub"}
@@ -0,0 +1,36 @@
+import pytest
+
+from api.alignment import EditConflict, edits_overlap, rebase_edits
+
+BASE = ["a", "b", "c", "d"]
+
+
+def test_rebase_unchanged():
+    edits = [(1, 2, ["B"])]
+    assert rebase_edits(BASE, list(BASE), edits) == edits
+
+
+def test_rebase_past_inserted_lines():
+    lines = ["new 1", "new 2", "a", "b", "c", "new 3", "d"]
+    assert rebase_edits(BASE, lines, [(1, 2, ["B"]), (3, 4, ["D"])]) == [
+        (3, 4, ["B"]),
+        (6, 7, ["D"]),
+    ]
+
+
+def test_rebase_conflict():
+    lines = ["a", "b changed", "c", "d"]
+    # Untouched lines still move across
+    assert rebase_edits(BASE, lines, [(2, 4, ["C", "D"])]) == [(2, 4, ["C", "D"])]
+    with pytest.raises(EditConflict, match="Line 2 changed"):
+        rebase_edits(BASE, lines, [(1, 2, ["B"])])
+    with pytest.raises(EditConflict, match="Lines 1-3 changed"):
+        rebase_edits(BASE, lines, [(0, 3, [])])
+
+
+def test_edits_overlap():
+    assert edits_overlap((1, 3, []), (2, 4, []))
+    assert not edits_overlap((1, 2, []), (2, 3, []))
+    # Inserts at the same line, their order would be arbitrary
+    assert edits_overlap((2, 2, ["x"]), (2, 2, ["y"]))
+    assert not edits_overlap((2, 2, ["x"]), (3, 3, ["y"]))
@@ -0,0 +1,124 @@
+from datetime import date
+
+from plaid import ApiException
+import pytest
+
+from api.collect_plaid import PlaidCollector, SyncCursors
+from api.serialise import importer_from_dict
+from plaid_stub import ACCOUNT_ID, PlaidStub, transaction
+
+CHECKING = "Assets:US:Bank:Checking"
+IMPORTER = importer_from_dict(
+    {
+        "name": "bank",
+        "access_token": "token",
+        "institution_id": "ins_stub",
+        "accounts": [{"name": CHECKING, "plaid_id": ACCOUNT_ID, "currency": "USD"}],
+    }
+)
+
+
+@pytest.fixture
+def stub():
+    stub = PlaidStub(pages=[])
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def collector(stub):
+    return PlaidCollector(
+        {"plaid": {"host": stub.host, "client-id": "client", "secret": "secret"}}
+    )
+
+
+def payees(ledgers):
+    return [entry.payee for entry in ledgers[CHECKING] if hasattr(entry, "payee")]
+
+
+def test_sync_follows_has_more(stub, collector):
+    stub.pages = [
+        {"added": [transaction("t1", "2023-10-01", 1, "one")]},
+        {"added": [transaction("t2", "2023-10-02", 2, "two")]},
+        {"added": [transaction("t3", "2023-10-03", 3, "three")]},
+    ]
+    ledgers, cursor, removed = collector.sync_transactions(IMPORTER, None)
+    assert payees(ledgers) == ["one", "two", "three"]
+    assert cursor == "3"
+    assert removed == []
+    assert stub.sync_cursors() == [None, "1", "2"]
+
+
+def test_first_sync_cut_at_start(stub, collector, tmp_path):
+    stub.pages = [
+        {
+            "added": [
+                transaction("t1", "2023-09-30", 1, "before"),
+                transaction("t2", "2023-10-01", 2, "on"),
+            ]
+        }
+    ]
+    cursors = SyncCursors(tmp_path / "cursors.json")
+    ledgers, _ = collector.sync_into(IMPORTER, cursors, date(2023, 10, 1), lambda l: l)
+    assert payees(ledgers) == ["on"]
+    # Once there is a cursor, everything Plaid sends is new
+    stub.pages.append({"added": [transaction("t3", "2023-09-29", 3, "late")]})
+    ledgers, _ = collector.sync_into(IMPORTER, cursors, date(2023, 10, 1), lambda l: l)
+    assert payees(ledgers) == ["late"]
+
+
+def test_cursor_saved_after_insert(stub, collector, tmp_path):
+    stub.pages = [{"added": [transaction("t1", "2023-10-01", 1, "one")]}]
+    cursors = SyncCursors(tmp_path / "cursors.json")
+
+    def failing_insert(ledgers):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        collector.sync_into(IMPORTER, cursors, None, failing_insert)
+    assert cursors.get(IMPORTER.name) is None
+    inserted, _ = collector.sync_into(IMPORTER, cursors, None, payees)
+    assert inserted == ["one"]
+    assert cursors.get(IMPORTER.name) == "1"
+    assert stub.sync_cursors() == [None, None]
+
+
+def test_sync_restarts_on_mutation(stub, collector):
+    stub.pages = [
+        {"added": [transaction("t1", "2023-10-01", 1, "one")]},
+        {"added": [transaction("t2", "2023-10-02", 2, "two")]},
+    ]
+    # The first page goes through, then the second fails
+    stub.errors = {1: (400, "TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION")}
+    ledgers, cursor, _ = collector.sync_transactions(IMPORTER, None)
+    assert payees(ledgers) == ["one", "two"]
+    assert cursor == "2"
+    assert stub.sync_cursors() == [None, "1", None, "1"]
+
+
+def test_sync_gives_up_after_restarts(stub, collector):
+    stub.pages = [{"added": [transaction("t1", "2023-10-01", 1, "one")]}]
+    stub.errors = {
+        i: (400, "TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION") for i in range(10)
+    }
+    with pytest.raises(ApiException):
+        collector.sync_transactions(IMPORTER, None)
+    assert len(stub.sync_cursors()) == 4
+
+
+def test_sync_reports_removed(stub, collector):
+    stub.pages = [
+        {
+            "added": [
+                transaction("t1", "2023-10-01", 1, "pending", pending=True),
+                transaction(
+                    "t3", "2023-10-02", 2, "posted", pending_transaction_id="t2"
+                ),
+            ],
+            "removed": ["t0", "t1", "t2"],
+        }
+    ]
+    ledgers, _, removed = collector.sync_transactions(IMPORTER, "0")
+    assert payees(ledgers) == ["posted"]
+    # t1 was never booked, and t2 was pending until it posted as t3
+    assert removed == ["t0"]
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from api.alignment import EditConflict, rebase_edits
+from api.ledger_writer import LedgerWriter
+
+OPEN = "2023-01-01 open Assets:{}"
+
+
+def write_lines(path, names):
+    path.write_text("".join(OPEN.format(name) + "\n" for name in names))
+
+
+def queue_while_locked(writer, path, batches):
+    """
+    Submits $batches from their own threads, in order, while $path is locked, so that
+    they are all written in one go. Returns the threads and { index => result }.
+    """
+    results = {}
+
+    def submit(i, batch):
+        try:
+            results[i] = writer.submit(path, batch)
+        except Exception as e:
+            results[i] = e
+
+    threads = []
+    queue = writer._queue(path)
+    with writer.locked(path):
+        for i, batch in enumerate(batches):
+            thread = threading.Thread(target=submit, args=(i, batch), daemon=True)
+            thread.start()
+            threads.append(thread)
+            deadline = time.monotonic() + 5
+            while len(queue.pending) <= i and time.monotonic() < deadline:
+                time.sleep(0.001)
+            assert len(queue.pending) == i + 1
+    for thread in threads:
+        thread.join(timeout=5)
+    assert not any(thread.is_alive() for thread in threads)
+    return results
+
+
+def append(name):
+    return lambda lines: ([(len(lines), len(lines), [OPEN.format(name)])], name)
+
+
+def test_submit(tmp_path):
+    path = tmp_path / "ledger.beancount"
+    write_lines(path, ["Cash"])
+    written = LedgerWriter().submit(path, append("Bank"))
+    assert written.before == OPEN.format("Cash") + "\n"
+    assert written.after == path.read_text()
+    assert written.value == "Bank"
+    assert path.read_text().splitlines() == [OPEN.format("Cash"), OPEN.format("Bank")]
+
+
+def test_same_line_inserts_in_rounds(tmp_path):
+    path = tmp_path / "ledger.beancount"
+    write_lines(path, ["Cash"])
+    writer = LedgerWriter()
+    results = queue_while_locked(writer, path, [append("A"), append("B"), append("C")])
+    # Each insert is at the end of the file, so they can only go one per round
+    assert path.read_text().splitlines() == [
+        OPEN.format(name) for name in ["Cash", "A", "B", "C"]
+    ]
+    assert [results[i].value for i in range(3)] == ["A", "B", "C"]
+    assert results[1].before == results[0].after
+    assert results[2].before == results[1].after
+
+
+def test_failed_batch_alone(tmp_path):
+    path = tmp_path / "ledger.beancount"
+    write_lines(path, ["Cash"])
+
+    def conflict(lines):
+        raise EditConflict("Line 1 changed since it was edited")
+
+    results = queue_while_locked(
+        LedgerWriter(), path, [append("A"), conflict, append("B")]
+    )
+    assert isinstance(results[1], EditConflict)
+    assert [results[0].value, results[2].value] == ["A", "B"]
+
+
+def test_write_failure_reaches_everyone(tmp_path):
+    path = tmp_path / "missing.beancount"
+    results = queue_while_locked(
+        LedgerWriter(), path, [append("A"), append("B"), append("C")]
+    )
+    assert all(isinstance(results[i], FileNotFoundError) for i in range(3))
+
+
+def test_write_together_conflict_writes_nothing(tmp_path):
+    a, b = tmp_path / "a.beancount", tmp_path / "b.beancount"
+    write_lines(a, ["Cash"])
+    write_lines(b, ["Bank"])
+    base = b.read_text().splitlines()
+    write_lines(b, ["Changed"])
+
+    with pytest.raises(EditConflict):
+        LedgerWriter().write_together(
+            {
+                a: append("A"),
+                b: lambda lines: (rebase_edits(base, lines, [(0, 1, ["x"])]), None),
+            }
+        )
+    assert a.read_text() == OPEN.format("Cash") + "\n"
+    assert b.read_text() == OPEN.format("Changed") + "\n"
+
+
+def test_write_together(tmp_path):
+    a, b = tmp_path / "a.beancount", tmp_path / "b.beancount"
+    write_lines(a, ["Cash"])
+    write_lines(b, ["Bank"])
+    written = LedgerWriter().write_together({a: append("A"), b: append("B")})
+    assert written[a].result().value == "A"
+    assert written[b].result().after == b.read_text()
+    assert b.read_text().splitlines() == [OPEN.format("Bank"), OPEN.format("B")]
+
+
+def test_write_failure_reaches_later_rounds(tmp_path, monkeypatch):
+    path = tmp_path / "ledger.beancount"
+    write_lines(path, ["Cash"])
+
+    def disk_full(path, contents):
+        raise OSError("disk full")
+
+    monkeypatch.setattr("api.ledger_writer.write_atomically", disk_full)
+    # B and C wait for the next rounds, which fail as well
+    results = queue_while_locked(
+        LedgerWriter(), path, [append("A"), append("B"), append("C")]
+    )
+    assert all(isinstance(results[i], OSError) for i in range(3))
+    assert path.read_text() == OPEN.format("Cash") + "\n"
@@ -0,0 +1,30 @@
+from api.utilities import text_diff
+
+
+def test_text_diff():
+    assert text_diff("a\nb\n", "a\nc\n", "f", 1) == (
+        "--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n"
+    )
+
+
+def test_text_diff_no_newline_before():
+    assert text_diff("a\nb", "a\nc\n", "f", 1) == (
+        "--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n"
+        "-b\n\\ No newline at end of file\n+c\n"
+    )
+
+
+def test_text_diff_no_newline_after():
+    assert text_diff("a\nb\n", "a\nc", "f", 1) == (
+        "--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n"
+        "-b\n+c\n\\ No newline at end of file\n"
+    )
+
+
+def test_text_diff_only_newline_added():
+    diff = text_diff("a\nb", "a\nb\n", "f", 1)
+    assert diff.endswith("-b\n\\ No newline at end of file\n+b\n")
+
+
+def test_text_diff_same():
+    assert text_diff("a\nb", "a\nb", "f") == ""
@@ -2,11 +2,11 @@ import dayjs from "dayjs";
 import relativeTime from "dayjs/plugin/relativeTime";
 import { List, Map as ImmMap } from "immutable";
 import React, { useEffect, useState } from "react";
-import ReactDiffViewer, { DiffMethod } from "react-diff-viewer";
 
 import { CollectMode } from "./beanTypes";
 import DisplayProgress, { TProgress } from "./DisplayProgress";
 import NavBar from "./NavBar";
+import TextDiff from "./TextDiff";
 import { API, errorHandler } from "./utilities";
 
 dayjs.extend(relativeTime);
@@ -30,8 +30,29 @@ const RUN_API = `${API}/collect/run`;
 interface IRunResponse {
   returncode: number;
   errors: Array<string>;
+  // Transactions that Plaid removed, which might already be in the ledger
+  removed?: Array<string>;
 }
 
+const RUN_ALL_STREAM_API = `${API}/collect/run-all/stream`;
+// One of these per line of the streamed response
+type TRunEvent =
+  | {
+      event: "fetch";
+      importer: string;
+      fetched: number;
+      total: number | null;
+    }
+  | { event: "fetched"; importer: string; entries: number }
+  | {
+      event: "insert";
+      importer: string;
+      account: string;
+      entries: number;
+      error: string | null;
+    }
+  | ({ event: "result"; importer: string } & IRunResponse);
+
 const LAST_IMPORTED_API = `${API}/collect/last-imported`;
 interface ILastImportedResponse {
   last: { [k: string]: string };
@@ -66,6 +87,8 @@ export default function CollectRun(props: {
   const [runProgress, setRunProgress] = useState<ImmMap<string, TProgress>>(
     ImmMap()
   );
+  // Map { importer name -> what it's up to, while running }
+  const [runStatus, setRunStatus] = useState<ImmMap<string, string>>(ImmMap());
   // Map { importer name -> list of errors }
   const [errors, setErrors] = useState<ImmMap<string, List<string>>>(ImmMap());
   // Map { account name -> last import date in YYYY-MM-DD }
@@ -82,6 +105,19 @@ export default function CollectRun(props: {
     ImmMap(secrets.importers.map((imp) => [imp.name, thirtyDaysAgo]))
   );
 
+  const setRunResult = (name: string, data: IRunResponse) => {
+    setRunStatus((rs) => rs.remove(name));
+    if (data.returncode !== 0) {
+      setErrors((errs) => errs.set(name, List(data.errors)));
+      setRunProgress((rp) => rp.set(name, "error"));
+    } else {
+      setRunProgress((rp) => rp.set(name, "success"));
+      setTimeout(() => {
+        setRunProgress((rp) => rp.remove(name));
+      }, 10 * 1000);
+    }
+  };
+
   const runImporter = async (importer: ImporterSchema) => {
     if (runProgress.get(importer.name) === "error") {
       // Skip running an error'd importer
@@ -103,21 +139,84 @@ export default function CollectRun(props: {
     });
     const data = (await resp.json()) as IRunResponse;
     console.log("POST", data);
-    if (data.returncode !== 0) {
-      setErrors((errs) => errs.set(importer.name, List(data.errors)));
-      setRunProgress((rp) => rp.set(importer.name, "error"));
-    } else {
-      setRunProgress((rp) => rp.set(importer.name, "success"));
-      setTimeout(() => {
-        setRunProgress((rp) => rp.remove(importer.name));
-      }, 10 * 1000);
-    }
+    setRunResult(importer.name, data);
   };
 
   const runAllImporters = async () => {
-    // Run them serially
-    for (const importer of secrets.importers) {
-      await runImporter(importer);
+    // Skip running error'd importers
+    const importers = secrets.importers.filter(
+      (imp) => runProgress.get(imp.name) !== "error"
+    );
+    setRunProgress((rp) =>
+      rp.merge(
+        importers.map((imp) => [imp.name, "in-process"] as [string, TProgress])
+      )
+    );
+    // The server fetches them concurrently
+    const body = {
+      end: endDate,
+      mode,
+      importers: importers.map((imp) => ({
+        ...imp,
+        start: startDates.get(imp.name)!,
+      })),
+    };
+    const resp = await fetch(RUN_ALL_STREAM_API, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify(body),
+    });
+    // Progress is streamed as newline-delimited JSON
+    const reader = resp.body!.getReader();
+    const decoder = new TextDecoder();
+    let buffered = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffered += decoder.decode(value, { stream: true });
+      const lines = buffered.split("\n");
+      buffered = lines.pop()!;
+      lines
+        .filter((line) => line.length > 0)
+        .forEach((line) => {
+          const ev = JSON.parse(line) as TRunEvent;
+          console.log("POST", ev);
+          onRunEvent(ev);
+        });
+    }
+  };
+
+  const onRunEvent = (ev: TRunEvent) => {
+    switch (ev.event) {
+      case "fetch":
+        setRunStatus((rs) =>
+          rs.set(
+            ev.importer,
+            ev.total !== null
+              ? `fetched ${ev.fetched} of ${ev.total}`
+              : `fetched ${ev.fetched}`
+          )
+        );
+        break;
+      case "fetched":
+        setRunStatus((rs) =>
+          rs.set(ev.importer, `inserting ${ev.entries} entries`)
+        );
+        break;
+      case "insert":
+        if (ev.error !== null) {
+          setErrors((errs) =>
+            errs.update(ev.importer, List(), (es) => es.push(ev.error!))
+          );
+        }
+        break;
+      case "result":
+        setRunResult(ev.importer, ev);
+        break;
     }
   };
 
@@ -199,6 +298,7 @@ export default function CollectRun(props: {
             imp={imp}
             runner={(imp) => runImporter(imp).catch(errorHandler)}
             runprogress={runProgress.get(imp.name)}
+            runstatus={runStatus.get(imp.name)}
             key={imp.name}
             lastimported={lastImported}
             start={startDates.get(imp.name)!}
@@ -221,26 +321,30 @@ export default function CollectRun(props: {
 
 const BACKUP_API = `${API}/collect/backup`;
 interface IBackupResponse {
-  contents: {
+  // Unified diff from the backup to the current ledger
+  diff: string;
+  // Every file that is different from the backup
+  changed: Record<string, "added" | "removed" | "modified">;
+  hashes: {
     old: string;
     new: string;
   };
+  // Both null until the first backup
+  snapshot: string | null;
   timestamps: {
-    last_backup: number;
+    last_backup: number | null;
   };
 }
 
 function Backup(props: { anyimporterrunning: boolean }) {
   const [showDiff, setShowDiff] = useState<boolean>(false);
-  const [before, setBefore] = useState<string>();
-  const [after, setAfter] = useState<string>();
+  const [diff, setDiff] = useState<string>();
   const [bkpProgress, setBkpProgress] = useState<TProgress>("idle");
   const [lastBackup, setLastBackup] = useState<number>();
 
-  function setDiff(newbefore: string, newafter: string, last: number) {
-    setBefore(newbefore);
-    setAfter(newafter);
-    setLastBackup(last);
+  function setBackup(newdiff: string, last: number | null) {
+    setDiff(newdiff);
+    setLastBackup(last ?? undefined);
   }
 
   useEffect(() => {
@@ -248,11 +352,7 @@ function Backup(props: { anyimporterrunning: boolean }) {
       const resp = await fetch(BACKUP_API);
       const data = (await resp.json()) as IBackupResponse;
       console.log("GET", data);
-      setDiff(
-        data.contents.old,
-        data.contents.new,
-        data.timestamps.last_backup
-      );
+      setBackup(data.diff, data.timestamps.last_backup);
     };
 
     if (bkpProgress !== "in-process") {
@@ -267,11 +367,7 @@ function Backup(props: { anyimporterrunning: boolean }) {
       });
       const data = (await resp.json()) as IBackupResponse;
       console.log("POST", data);
-      setDiff(
-        data.contents.old,
-        data.contents.new,
-        data.timestamps.last_backup
-      );
+      setBackup(data.diff, data.timestamps.last_backup);
       setBkpProgress("success");
       setTimeout(() => setBkpProgress("idle"), 10 * 1000);
     };
@@ -288,9 +384,9 @@ function Backup(props: { anyimporterrunning: boolean }) {
         <button
           className="bg-slate-700 px-1 border-solid border-2 rounded-lg hover:bg-white hover:text-black disabled:text-gray-400 disabled:border-gray-400"
           onClick={() => setShowDiff((show) => !show)}
-          disabled={!showDiff && before === after}
+          disabled={!showDiff && !diff}
         >
-          {showDiff ? "Hide diff" : before === after ? "No diff" : "View diff"}
+          {showDiff ? "Hide diff" : !diff ? "No diff" : "View diff"}
         </button>
         <span className="ml-3">
           <button
@@ -305,15 +401,9 @@ function Backup(props: { anyimporterrunning: boolean }) {
           <span className="ml-3">{dayjs.unix(lastBackup).fromNow()}</span>
         )}
       </p>
-      {showDiff && before && after ? (
+      {showDiff && diff ? (
         <div className="max-h-[60vh] overflow-y-auto">
-          <ReactDiffViewer
-            oldValue={before}
-            newValue={after}
-            splitView={false}
-            useDarkTheme={true}
-            compareMethod={DiffMethod.LINES}
-          />
+          <TextDiff diff={diff} />
         </div>
       ) : null}
     </>
@@ -374,6 +464,7 @@ function Importer(props: {
   imp: ImporterSchema;
   runner: (i: ImporterSchema) => void;
   runprogress: TProgress | undefined;
+  runstatus: string | undefined;
   lastimported: ImmMap<string, string>;
   start: string;
   onChangeStart: (d: string) => void;
@@ -410,6 +501,9 @@ function Importer(props: {
           className="bg-slate-300 text-black p-1 w-[12ch] mr-2 border-solid border-2 rounded-lg"
           disabled={props.anyimporterrunning}
         />
+        {props.runstatus && (
+          <span className="text-sky-200 mr-2">{props.runstatus}</span>
+        )}
         {props.runprogress ? (
           <DisplayProgress
             progress={props.runprogress}
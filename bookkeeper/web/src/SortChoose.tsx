@@ -4,28 +4,38 @@ import { List, Map as ImmMap, Set } from "immutable";
 import { CircularProgressbarWithChildren } from "react-circular-progressbar";
 import "react-circular-progressbar/dist/styles.css";
 
-import { IDirectiveForSort, IDirectiveMod } from "./beanTypes";
+import { IDirective, IDirectiveForSort, IDirectiveMod } from "./beanTypes";
 import Transaction from "./Transaction";
 import DisplayProgress, { TProgress } from "./DisplayProgress";
 import { API, errorHandler } from "./utilities";
 import NavBar from "./NavBar";
 
 const NEXT_API = `${API}/sort/next`;
+const ACCOUNTS_API = `${API}/sort/accounts`;
 const LINK_API = `${API}/sort/link`;
+// How many txns to keep on screen
+const PAGE_SIZE = 20;
 
 interface INextResponse {
+  // Send this back, to only get the txns that haven't been sent yet
+  cursor: string;
   to_sort: Array<IDirectiveForSort>;
-  accounts: Array<string>;
   count_total: number;
   count_sorted: number;
 }
 
+interface IAccountsResponse {
+  accounts: Array<string>;
+}
+
 interface ISortedRequest {
   sorted: Array<IDirectiveMod>;
 }
 
 interface ILinkResponse {
   results: Array<IDirectiveForSort>;
+  // Already categorised, so can't be sorted here
+  ledger: Array<IDirective>;
 }
 
 export default function SortChoose() {
@@ -39,30 +49,46 @@ export default function SortChoose() {
   // "accounts" is used for auto-complete
   const [accounts, setAccounts] = useState<Set<string>>(Set());
   const [totalToSort, setTotalToSort] = useState<number>(0);
-  const [numSorted, setNumSorted] = useState<number>(0);
+  // Sorted as far as the server knows, so doesn't include "sorted"
+  const [countSorted, setCountSorted] = useState<number>(0);
+  const cursor = useRef<string>();
+  // Matches for the last link search that are already in the ledger
+  const [linkedInLedger, setLinkedInLedger] = useState<List<IDirective>>(
+    List()
+  );
 
   useEffect(() => {
     const fetchData = async () => {
-      const resp = await fetch(NEXT_API);
+      const resp = await fetch(nextURL(undefined, PAGE_SIZE));
       const data = (await resp.json()) as INextResponse;
       console.log("GET", data);
-      setUnsorted((uns) =>
-        uns.concat(filterToUnseen(uns, sorted, data.to_sort))
-      );
-      setAccounts(Set(data.accounts));
+      cursor.current = data.cursor;
+      setUnsorted(List(data.to_sort));
       setTotalToSort(data.count_total);
-      setNumSorted(data.count_sorted + sorted.size);
+      setCountSorted(data.count_sorted);
+    };
+    // Revalidated with its ETag, so this is usually a 304
+    const fetchAccounts = async () => {
+      const resp = await fetch(ACCOUNTS_API);
+      const data = (await resp.json()) as IAccountsResponse;
+      setAccounts(Set(data.accounts));
     };
 
     fetchData().catch(errorHandler);
-  }, [mods, sorted]);
+    fetchAccounts().catch(errorHandler);
+  }, []);
 
   const saveChanges = async () => {
     setAsyncProgress("in-process");
     const body: ISortedRequest = {
       sorted: mods.valueSeq().toArray(),
     };
-    const resp = await fetch(NEXT_API, {
+    // Top up what's left on screen
+    const url = nextURL(
+      cursor.current,
+      Math.max(PAGE_SIZE - unsorted.size, 0)
+    );
+    const resp = await fetch(url, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -73,12 +99,14 @@ export default function SortChoose() {
     console.log("POST", data);
     setAsyncProgress("success");
     setTotalToSort(data.count_total);
-    setNumSorted(data.count_sorted);
+    // A new cursor means that the server started over
+    const startOver = data.cursor !== cursor.current;
+    cursor.current = data.cursor;
     setTimeout(() => {
       setUnsorted(
-        unsorted.concat(filterToUnseen(unsorted, sorted, data.to_sort))
+        startOver ? List(data.to_sort) : unsorted.concat(data.to_sort)
       );
-      setAccounts(Set(data.accounts));
+      setCountSorted(data.count_sorted);
       setSorted(List());
       setMods(ImmMap());
       setAsyncProgress("idle");
@@ -89,6 +117,9 @@ export default function SortChoose() {
     const params = new URLSearchParams();
     params.append("txnID", txnID);
     params.append("amount", amount);
+    if (cursor.current) {
+      params.append("cursor", cursor.current);
+    }
     const url = new URL(LINK_API);
     url.search = params.toString();
     const resp = await fetch(url);
@@ -98,6 +129,7 @@ export default function SortChoose() {
       // Need to check that we aren't adding dupe transactions to the list.
       filterToUnseen(unsorted, sorted, data.results).concat(unsorted)
     );
+    setLinkedInLedger(List(data.ledger));
   };
 
   const refs = useRef<Map<string, HTMLInputElement>>(new Map());
@@ -113,6 +145,7 @@ export default function SortChoose() {
     nextVal && nextVal.focus();
   }, [unsorted]);
 
+  const numSorted = countSorted + sorted.size;
   const percent = (100 * numSorted) / totalToSort;
   const percentFmted = new Intl.NumberFormat("en-US", {
     maximumFractionDigits: 1,
@@ -148,7 +181,6 @@ export default function SortChoose() {
             // Put this back in the front of "unsorted", and remove from "sorted"
             setUnsorted(unsorted.unshift(txn));
             setSorted(sorted.remove(sidx));
-            setNumSorted(numSorted - 1);
           }}
           onLink={(txnID) => {
             const linker = sorted.find((dir) => dir.id === txnID)!;
@@ -157,6 +189,19 @@ export default function SortChoose() {
           }}
         />
       ))}
+      {linkedInLedger.size > 0 ? (
+        <div className="p-4 my-2 border-solid border-2 rounded-lg">
+          <p className="text-sky-200">Already in the ledger</p>
+          {linkedInLedger.map((entry) => (
+            <p key={`${entry.filename}:${entry.lineno}`}>
+              {entry.date} {entry.payee}{" "}
+              <code className="text-green-300">
+                {entry.postings.map((p) => p.account).join(", ")}
+              </code>
+            </p>
+          ))}
+        </div>
+      ) : null}
       {unsorted.map((dir) => (
         <Transaction
           txn={dir}
@@ -175,7 +220,6 @@ export default function SortChoose() {
             // Update "unsorted" and "sorted"
             setSorted(sorted.concat(unsorted.filter(modIDsHas)));
             setUnsorted(unsorted.filterNot(modIDsHas));
-            setNumSorted(numSorted + 1);
           }}
         />
       ))}
@@ -216,6 +260,17 @@ export default function SortChoose() {
   );
 }
 
+function nextURL(cursor: string | undefined, max: number): URL {
+  const params = new URLSearchParams();
+  params.append("max", max.toString());
+  if (cursor) {
+    params.append("cursor", cursor);
+  }
+  const url = new URL(NEXT_API);
+  url.search = params.toString();
+  return url;
+}
+
 function filterToUnseen(
   unsorted: List<IDirectiveForSort>,
   sorted: List<IDirectiveForSort>,
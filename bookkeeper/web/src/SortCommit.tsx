@@ -1,6 +1,5 @@
 import React, { useEffect, useState } from "react";
 import { Link } from "react-router-dom";
-import ReactDiffViewer, { DiffMethod } from "react-diff-viewer";
 import { Map as ImmMap } from "immutable";
 import {
   CheckCircleIcon,
@@ -9,24 +8,31 @@ import {
 
 import { API, errorHandler } from "./utilities";
 import NavBar from "./NavBar";
+import TextDiff from "./TextDiff";
 
 const COMMIT_API = `${API}/sort/commit`;
 const CHECK_API = `${API}/sort/check`;
 
 interface ICommitResponse {
-  before: string;
-  after: string;
+  // Unified diff of each destination file with edits
+  diff: string;
+  hashes: Record<string, { before: string; after: string }>;
   written: boolean;
 }
 
 interface ICheckResponse {
   check: boolean;
+  // A newer check took over, so this one has no result
+  cancelled?: boolean;
   errors: Record<string, string>;
 }
 
+interface IConflictResponse {
+  error: string;
+}
+
 export default function SortCommit() {
-  const [before, setBefore] = useState<string>();
-  const [after, setAfter] = useState<string>();
+  const [diff, setDiff] = useState<string>();
   const [errors, setErrors] = useState<ImmMap<string, string>>(ImmMap());
   const [checkPassed, setCheckPassed] = useState<boolean>();
   const [written, setWritten] = useState<boolean>(false);
@@ -34,10 +40,10 @@ export default function SortCommit() {
   useEffect(() => {
     const fetchData = async () => {
       const resp = await fetch(COMMIT_API);
+      await throwOnConflict(resp);
       const data = (await resp.json()) as ICommitResponse;
       console.log("GET", data);
-      setBefore(data.before);
-      setAfter(data.after);
+      setDiff(data.diff);
     };
 
     fetchData().catch(errorHandler);
@@ -51,10 +57,10 @@ export default function SortCommit() {
     const resp = await fetch(url, {
       method: "POST",
     });
+    await throwOnConflict(resp);
     const data = (await resp.json()) as ICommitResponse;
     console.log("POST", data);
-    setBefore(data.before);
-    setAfter(data.after);
+    setDiff(data.diff);
     setWritten(data.written);
   };
 
@@ -62,8 +68,12 @@ export default function SortCommit() {
     const resp = await fetch(CHECK_API, {
       method: "POST",
     });
+    await throwOnConflict(resp);
     const data = (await resp.json()) as ICheckResponse;
     console.log("POST", data);
+    if (data.cancelled) {
+      return;
+    }
     setCheckPassed(data.check);
     setErrors(ImmMap(data.errors));
   };
@@ -101,13 +111,7 @@ export default function SortCommit() {
         </div>
       )}
       <div className="max-h-[90vh] overflow-y-auto">
-        <ReactDiffViewer
-          oldValue={before}
-          newValue={after}
-          splitView={false}
-          useDarkTheme={true}
-          compareMethod={DiffMethod.LINES}
-        />
+        {diff !== undefined && <TextDiff diff={diff} />}
       </div>
       <div className="my-3 text-center">
         <Link to={`/sort/choose`}>
@@ -141,3 +145,11 @@ export default function SortCommit() {
     </div>
   );
 }
+
+// The lines of a mod were changed since they were sorted, eg. by hand
+async function throwOnConflict(resp: Response) {
+  if (resp.status === 409) {
+    const data = (await resp.json()) as IConflictResponse;
+    throw new Error(data.error);
+  }
+}
@@ -1,6 +1,5 @@
 import React, { useEffect, useState } from "react";
 import { Link } from "react-router-dom";
-import dayjs from "dayjs";
 import { List } from "immutable";
 
 import { API, errorHandler } from "./utilities";
@@ -12,26 +11,20 @@ const PROGRESS_API = `${API}/sort/progress`;
 interface IProgressResponse {
   journal_files: Array<string>;
   main_file: string | null;
-  destination_file: string | null;
+  destination_files: Array<string> | null;
   expense_accounts: Array<string>;
 }
 
 export default function SortOptions() {
   const [journalFiles, setJournalFiles] = useState<List<string>>(List());
-  const [destFile, setDestFile] = useState<string>();
+  const [destFiles, setDestFiles] = useState<Array<string>>([]);
   const [asyncProgress, setAsyncProgress] = useState<TProgress>("idle");
 
   function setStateFromAPI(data: IProgressResponse) {
     const journalFiles = List(data.journal_files).sort();
     setJournalFiles(journalFiles);
-    if (data.destination_file) {
-      setDestFile(data.destination_file);
-    } else {
-      const thisYear = `${dayjs().year()}.beancount`;
-      if (journalFiles.contains(thisYear)) {
-        setDestFile(thisYear);
-      }
-    }
+    // Sort across all of them, unless told otherwise
+    setDestFiles(data.destination_files || journalFiles.toArray());
   }
 
   useEffect(() => {
@@ -76,14 +69,18 @@ export default function SortOptions() {
         }}
       >
         <p className="py-1">
-          <label htmlFor="destination_file" className="mr-1">
-            Destination file:
+          <label htmlFor="destination_files" className="mr-1">
+            Destination files:
           </label>
           <select
-            name="destination_file"
-            value={destFile}
-            onChange={(ev) => setDestFile(ev.target.value)}
-            required
+            name="destination_files"
+            multiple
+            value={destFiles}
+            onChange={(ev) =>
+              setDestFiles(
+                Array.from(ev.target.selectedOptions, (opt) => opt.value)
+              )
+            }
             className="text-black"
           >
             {journalFiles.map((f) => (
@@ -0,0 +1,33 @@
+import React from "react";
+
+/**
+ * Renders a unified diff, as sent by the API
+ */
+export default function TextDiff(props: { diff: string }) {
+  const lines = props.diff.split("\n");
+  if (lines[lines.length - 1] === "") {
+    lines.pop();
+  }
+  return (
+    <pre className="text-sm overflow-x-auto">
+      {lines.map((line, idx) => (
+        <div key={idx} className={lineClass(line)}>
+          {line}
+        </div>
+      ))}
+    </pre>
+  );
+}
+
+function lineClass(line: string): string {
+  if (line.startsWith("+++") || line.startsWith("---")) {
+    return "text-gray-400";
+  } else if (line.startsWith("@@")) {
+    return "text-sky-400";
+  } else if (line.startsWith("+")) {
+    return "bg-green-900";
+  } else if (line.startsWith("-")) {
+    return "bg-red-900";
+  }
+  return "";
+}
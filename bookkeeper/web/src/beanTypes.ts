@@ -3,7 +3,7 @@ export interface IDirectiveForSort {
   auto_category: string | null;
   entry: IDirective;
 }
-interface IDirective {
+export interface IDirective {
   date: string;
   filename: string;
   lineno: number;